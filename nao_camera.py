@@ -0,0 +1,259 @@
+import threading
+import time
+import cv2
+import numpy as np
+
+# color spaces of ALVideoDevice, see vision_definitions
+kYUV422ColorSpace = 9
+kBGRColorSpace = 13
+
+
+def ImageToArray(naoImage, frame=None, copy=True):
+    '''Turns the result of `getImageRemote` into an OpenCV image.
+
+    The 6th index of `naoImage` contains the raw image data, which is wrapped
+    with `np.frombuffer` (no copy) and reshaped to (height, width, nchannels).
+    If `frame` is given and has the same size, the data is copied into it,
+    so the same array can be reused for every frame. A new array is only
+    allocated on the first pass or when width, height or the number of
+    channels change. With `copy=False` the read-only view on the received
+    data is returned directly, which avoids the copy altogether.
+    '''
+    # extract fields
+    width = naoImage[0]
+    height = naoImage[1]
+    nchannels = naoImage[2]
+    imgbuffer = naoImage[6]
+
+    shape = (height, width, nchannels)
+    data = np.frombuffer(imgbuffer, dtype=np.uint8).reshape(shape)
+
+    if not copy:
+        return data
+
+    # (re)allocate on first pass or if the image format has changed
+    if frame is None or frame.shape != shape:
+        print('Obtained image of size {} x {}, with {} channels'.format(width, height, nchannels))
+        frame = np.empty(shape, dtype=np.uint8)
+
+    np.copyto(frame, data)
+
+    return frame
+
+
+def YUV422ToHSV(yuv, hsv=None, bgr=None):
+    '''Converts a YUV422 image (as delivered with kYUV422ColorSpace) to HSV.
+
+    `yuv` has the shape (height, width, 2): the first channel holds the luma of
+    every pixel, the second one alternates between U and V for each pair of
+    pixels (YUYV). OpenCV converts it to BGR and the BGR image to HSV, so the
+    colors are those of the image that is shown and saved, with OpenCV's 8-bit
+    HSV ranges (hue in [0, 180), saturation and value in [0, 255]) and the
+    color bounds of `DetectBall` can be used unchanged. If `hsv` and `bgr`
+    have the right size, the result and the BGR image are written into them.
+    '''
+    bgr = YUV422ToBGR(yuv, bgr)
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV, dst=hsv)
+
+
+def YUV422ToBGR(yuv, bgr=None):
+    '''Converts a YUV422 image to BGR, e.g. to draw on it and show it.'''
+    return cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_YUYV, dst=bgr)
+
+
+class CaptureThread(threading.Thread):
+    '''Retrieves images from a subscribed camera on its own thread.
+
+    The images are copied into a small ring of preallocated frames. `read`
+    always returns the newest frame without waiting for the network, so the
+    round trip to the robot overlaps with the processing of the previous
+    frame. The slot returned by `read` is not overwritten until the next
+    call to `read`, hence it is safe to draw on it.
+
+    `dropped` counts frames that were replaced before anyone read them and
+    `duplicates` counts calls to `read` that returned an already seen frame.
+    '''
+
+    def __init__(self, camProxy, nameID, n_slots=3):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        if n_slots < 3:
+            raise ValueError('at least 3 slots are needed, got {}'.format(n_slots))
+
+        self.camProxy = camProxy
+        self.nameID = nameID
+
+        self.frames = [None] * n_slots
+        self.timestamps = [None] * n_slots
+        self.seqs = [0] * n_slots
+
+        self.latest = None      # slot of the newest frame
+        self.reading = None     # slot held by the consumer
+        self.last_seq = 0       # sequence number of the last frame read
+        self.seq = 0
+
+        self.captured = 0
+        self.dropped = 0
+        self.duplicates = 0
+
+        self.lock = threading.Lock()
+        self.new_frame = threading.Condition(self.lock)
+        self.running = True
+        self.error = None
+
+    def run(self):
+        n_slots = len(self.frames)
+        slot = 0
+        while self.running:
+            try:
+                naoImage = self.camProxy.getImageRemote(self.nameID)
+            except Exception as e:
+                # handed over to the consumer by `read`
+                with self.lock:
+                    self.error = e
+                    self.running = False
+                    self.new_frame.notify_all()
+                break
+            if naoImage is None:
+                continue
+
+            # pick a slot that is neither the newest nor held by the consumer
+            with self.lock:
+                while slot == self.latest or slot == self.reading:
+                    slot = (slot + 1) % n_slots
+
+            self.frames[slot] = ImageToArray(naoImage, self.frames[slot])
+
+            with self.lock:
+                if self.latest is not None and self.seqs[self.latest] > self.last_seq:
+                    self.dropped += 1
+                self.seq += 1
+                self.seqs[slot] = self.seq
+                self.timestamps[slot] = naoImage[4] + naoImage[5] * 1e-6
+                self.latest = slot
+                self.captured += 1
+                self.new_frame.notify_all()
+
+    def read(self, timeout=None):
+        '''Returns the newest frame, or None if no frame arrived yet.
+
+        With a `timeout` (in seconds) it waits up to that long for a frame that
+        has not been read before. Raises the error the capture thread stopped with.
+        '''
+        with self.lock:
+            if timeout is not None and (self.latest is None or self.seqs[self.latest] == self.last_seq):
+                self.new_frame.wait(timeout)
+
+            if self.error is not None:
+                raise self.error
+
+            if self.latest is None:
+                return None
+
+            if self.seqs[self.latest] == self.last_seq:
+                self.duplicates += 1
+            self.last_seq = self.seqs[self.latest]
+            self.reading = self.latest
+
+            return self.frames[self.reading]
+
+    def read_timestamp(self):
+        '''NAOqi timestamp (in seconds) of the frame returned by the last `read`.'''
+        with self.lock:
+            if self.reading is None:
+                return None
+            return self.timestamps[self.reading]
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def stats(self):
+        return {'captured': self.captured,
+                'dropped': self.dropped,
+                'duplicates': self.duplicates}
+
+
+class DualCamera(object):
+    '''Retrieves the images of the top and the bottom camera with one call.
+
+    `nameID` has to come from `subscribeCameras` with the camera indices
+    [0, 1]. Each `grab` calls `getImagesRemote` once and copies both images
+    into one preallocated array with the top image above the bottom image,
+    so `DetectBall` can run on both in a single pass. `pad` black rows keep
+    the two images apart, so neither the blur, erode and dilate nor the
+    contours join a ball at the bottom edge of the top image with one at the
+    top edge of the bottom image. `split_center` maps a position in that
+    array back to the camera and its own image.
+
+    The two cameras are not triggered together, `skew` holds the difference
+    of the two timestamps (in seconds) of the last pair. If it is larger
+    than `max_skew`, `grab` waits for the next images of both cameras (one
+    frame at `fps`) and retrieves them once more, the pair with the smaller
+    skew is kept. `retried` counts these calls and `skewed` the pairs that
+    were still apart by more than `max_skew`. `grab` returns None if the
+    cameras have not taken new images since the last pair.
+    '''
+
+    def __init__(self, camProxy, nameID, fps=30, max_skew=0.02, pad=16):
+        self.camProxy = camProxy
+        self.nameID = nameID
+        self.period = 1.0 / fps
+        self.max_skew = max_skew
+        self.pad = pad
+
+        self.frame = None
+        self.height = None
+        self.timestamps = (None, None)
+        self.skew = None
+
+        self.grabbed = 0
+        self.retried = 0
+        self.skewed = 0
+
+    def _retrieve(self):
+        naoImages = self.camProxy.getImagesRemote(self.nameID)
+        timestamps = tuple(naoImage[4] + naoImage[5] * 1e-6 for naoImage in naoImages)
+        return naoImages, timestamps, abs(timestamps[0] - timestamps[1])
+
+    def grab(self):
+        previous = self.timestamps
+        naoImages, self.timestamps, self.skew = self._retrieve()
+        if self.timestamps == previous:
+            return None
+        if self.skew > self.max_skew:
+            # asking again right away returns the same pair
+            time.sleep(self.period)
+            retry = self._retrieve()
+            self.retried += 1
+            if retry[2] < self.skew:
+                naoImages, self.timestamps, self.skew = retry
+            if self.skew > self.max_skew:
+                self.skewed += 1
+        self.grabbed += 1
+
+        top, bottom = naoImages
+        shape = (2 * top[1] + self.pad, top[0], top[2])
+        if self.frame is None or self.frame.shape != shape:
+            print('Obtained two images of size {} x {}, with {} channels'.format(top[0], top[1], top[2]))
+            self.frame = np.empty(shape, dtype=np.uint8)
+            self.height = top[1]
+            # black, (Y, U/V) = (16, 128) for kYUV422ColorSpace
+            self.frame[self.height:self.height + self.pad] = (16, 128) if top[3] == kYUV422ColorSpace else 0
+
+        ImageToArray(top, self.frame[:self.height])
+        ImageToArray(bottom, self.frame[self.height + self.pad:])
+
+        return self.frame
+
+    def split_center(self, center):
+        '''Returns the camera index (0 top, 1 bottom) and the position in its image.'''
+        if center[1] < self.height + self.pad // 2:
+            return 0, center
+        return 1, (center[0], center[1] - self.height - self.pad)
+
+    def stats(self):
+        return {'grabbed': self.grabbed,
+                'retried': self.retried,
+                'skewed': self.skewed}
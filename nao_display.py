@@ -0,0 +1,82 @@
+import threading
+import time
+import cv2
+import numpy as np
+
+
+class DisplayThread(threading.Thread):
+    '''Shows images in OpenCV windows on its own thread, at its own rate.
+
+    The processing loop hands its images over with `show`, which never waits
+    for the GUI. An image is only copied if the display is due to render it,
+    at most `fps` times per second and window, the thread renders the newest
+    copy of each window and polls the keyboard. All GUI calls happen on this
+    thread, the loop does not call `cv2.waitKey` any more. Pressing q or Esc
+    in a window sets `quit`, which the loop checks to stop.
+    '''
+
+    def __init__(self, fps=10):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.period = 1.0 / fps
+        self.images = {}        # newest copy of each window
+        self.updated = set()    # windows with a copy that is not shown yet
+        self.last_copy = {}
+
+        self.shown = 0
+        self.skipped = 0
+
+        self.lock = threading.Lock()
+        self.quit = threading.Event()
+        self.running = True
+
+    def show(self, name, image):
+        '''Hands over the image of a window, returns False if it was skipped.'''
+        now = time.time()
+        with self.lock:
+            if now - self.last_copy.get(name, 0.0) < self.period:
+                self.skipped += 1
+                return False
+            self.last_copy[name] = now
+
+            # (re)allocate on first pass or if the image format has changed
+            copy = self.images.get(name)
+            if copy is None or copy.shape != image.shape:
+                copy = np.empty(image.shape, dtype=image.dtype)
+                self.images[name] = copy
+            np.copyto(copy, image)
+            self.updated.add(name)
+        return True
+
+    def run(self):
+        next_frame = time.time()
+        while self.running:
+            # take the new copies out, so `show` does not wait for the rendering
+            with self.lock:
+                pending = [(name, self.images.pop(name)) for name in self.updated]
+                self.updated.clear()
+            for name, image in pending:
+                cv2.imshow(name, image)
+            with self.lock:
+                self.shown += len(pending)
+                for name, image in pending:
+                    # reused by the next `show`, unless it already made a new copy
+                    self.images.setdefault(name, image)
+
+            # the rest of the period waits for a key instead of sleeping
+            wait_ms = max(1, int((next_frame + self.period - time.time()) * 1000))
+            key = cv2.waitKey(wait_ms) & 0xFF
+            if key == ord('q') or key == 27:
+                self.quit.set()
+            next_frame = max(next_frame + self.period, time.time())
+
+        cv2.destroyAllWindows()
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def stats(self):
+        return {'shown': self.shown,
+                'skipped': self.skipped}
@@ -0,0 +1,400 @@
+import argparse
+import os
+import glob
+import time
+import threading
+import collections
+import cv2
+import numpy as np
+
+from nao_camera import kYUV422ColorSpace, YUV422ToBGR
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+'''A recording is a series of segment files, e.g. session_0000.frames, session_0001.frames, ...'''
+'''Each segment starts with a header of HEADER_SIZE bytes followed by `capacity` records of the same size,'''
+'''a record holds the NAOqi timestamp of the image (naoImage[4] and naoImage[5]) and the raw image data.'''
+'''Events, e.g. touching a tactile, are written as lines `seconds microseconds name value` to session.events.'''
+MAGIC = b'NAOFRAME'
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([('magic', 'S8'),
+                         ('height', '<u4'),
+                         ('width', '<u4'),
+                         ('channels', '<u4'),
+                         ('color_space', '<u4'),
+                         ('capacity', '<u4'),
+                         ('count', '<u4')])
+
+
+def RecordDtype(shape):
+    return np.dtype([('seconds', '<i4'),
+                     ('microseconds', '<i4'),
+                     ('frame', np.uint8, tuple(shape))])
+
+
+def SegmentPath(prefix, index):
+    return '{}_{:04d}.frames'.format(prefix, index)
+
+
+def OpenSegment(path):
+    '''Maps a segment file read-only, returns its header and the recorded frames.
+
+    The frames are a structured array with the fields 'seconds', 'microseconds'
+    and 'frame', nothing is read from the disk until it is accessed.
+    '''
+    header = np.memmap(path, dtype=HEADER_DTYPE, mode='r', shape=(1,))[0]
+    if header['magic'] != MAGIC:
+        raise ValueError('{} is not a frame recording'.format(path))
+
+    shape = (int(header['height']), int(header['width']), int(header['channels']))
+    count = int(header['count'])
+    if count == 0:
+        return header, np.zeros(0, dtype=RecordDtype(shape))
+
+    records = np.memmap(path, dtype=RecordDtype(shape), mode='r',
+                        offset=HEADER_SIZE, shape=(count,))
+    return header, records
+
+
+def RecordingSegments(prefix):
+    return sorted(glob.glob('{}_[0-9][0-9][0-9][0-9].frames'.format(prefix)))
+
+
+def SessionPrefix(directory='.'):
+    '''A prefix of its own for every run, e.g. ./session_20261018_143501.'''
+    return os.path.join(directory, time.strftime('session_%Y%m%d_%H%M%S'))
+
+
+def EventsPath(prefix):
+    return '{}.events'.format(prefix)
+
+
+def ReadEvents(prefix):
+    '''Returns the recorded events as a list of (seconds, microseconds, name, value).'''
+    events = []
+    if not os.path.isfile(EventsPath(prefix)):
+        return events
+
+    with open(EventsPath(prefix), 'r') as stream:
+        for line in stream:
+            seconds, microseconds, name, value = line.split()
+            events.append((int(seconds), int(microseconds), name, float(value)))
+    return events
+
+
+class FrameRecorder(object):
+    '''Appends raw frames and their timestamps to memory-mapped segment files.
+
+    Appending a frame is a single copy into the mapped file, writing it to the
+    disk is left to the operating system, so recording does not stall the
+    loop that retrieves the images. There is no encoding involved, JPEG files
+    can be exported offline with `ExportJPEG`.
+
+    In continuous mode every frame passed to `offer` is recorded, otherwise
+    only as many frames as were requested with `trigger` (which may be called
+    from another thread, e.g. a NAOqi callback).
+
+    `event` logs e.g. a touch together with the timestamp of the last offered
+    frame, so a replay can raise it at the same point of the recording.
+
+    The segment and events files are created with the first frame and the
+    first event, a run that records nothing leaves nothing behind.
+
+    A recording never extends an older one with the same prefix: if segments
+    or events of `prefix` exist, they are deleted with `overwrite`, otherwise
+    a ValueError is raised before anything is written. `SessionPrefix` gives
+    every run a prefix of its own.
+    '''
+
+    def __init__(self, prefix, continuous=False, capacity=900, color_space=13, overwrite=False):
+        self.prefix = prefix
+        self.continuous = continuous
+        self.capacity = capacity
+        self.color_space = color_space
+
+        self.segment = -1
+        self.header = None
+        self.records = None
+        self.recorded = 0
+
+        self.pending = 0
+        self.lock = threading.Lock()
+
+        self.timestamp = (0, 0)
+        self.events = None
+        self.closed = False
+
+        # the replay would mix the segments and events of both recordings
+        existing = RecordingSegments(prefix)
+        if os.path.isfile(EventsPath(prefix)):
+            existing.append(EventsPath(prefix))
+        if existing and not overwrite:
+            raise ValueError('{} already holds a recording ({} files), choose another prefix or overwrite it'.format(
+                prefix, len(existing)))
+        for path in existing:
+            os.remove(path)
+
+    def trigger(self, n_frames=1):
+        '''Records the next `n_frames` frames that are offered.'''
+        with self.lock:
+            self.pending += n_frames
+
+    def offer(self, frame, seconds, microseconds):
+        '''Records the frame if recording continuously or if a trigger is pending.'''
+        self.timestamp = (seconds, microseconds)
+        if not self.continuous:
+            with self.lock:
+                if self.pending == 0:
+                    return False
+                self.pending -= 1
+
+        self.append(frame, seconds, microseconds)
+        return True
+
+    def event(self, name, value):
+        '''Logs an event at the timestamp of the last offered frame.'''
+        with self.lock:
+            if self.closed:
+                return
+            if self.events is None:
+                self._make_directory()
+                self.events = open(EventsPath(self.prefix), 'w')
+            self.events.write('{} {} {} {}\n'.format(self.timestamp[0], self.timestamp[1], name, float(value)))
+            self.events.flush()
+
+    def append(self, frame, seconds, microseconds):
+        if (self.records is None or self.header['count'] == self.capacity or
+                self.records.dtype['frame'].shape != frame.shape):
+            self._next_segment(frame.shape)
+
+        i = self.header['count']
+        record = self.records[i]
+        record['seconds'] = seconds
+        record['microseconds'] = microseconds
+        record['frame'] = frame
+        self.header['count'] = i + 1
+        self.recorded += 1
+
+    def _next_segment(self, shape):
+        self._close_segment()
+        self.segment += 1
+        path = SegmentPath(self.prefix, self.segment)
+        self._make_directory()
+
+        record_dtype = RecordDtype(shape)
+        with open(path, 'wb') as stream:
+            stream.truncate(HEADER_SIZE + self.capacity * record_dtype.itemsize)
+
+        self.header = np.memmap(path, dtype=HEADER_DTYPE, mode='r+', shape=(1,))[0]
+        self.header['magic'] = MAGIC
+        self.header['height'], self.header['width'], self.header['channels'] = shape
+        self.header['color_space'] = self.color_space
+        self.header['capacity'] = self.capacity
+        self.header['count'] = 0
+
+        self.records = np.memmap(path, dtype=record_dtype, mode='r+',
+                                 offset=HEADER_SIZE, shape=(self.capacity,))
+        print('recording to {}'.format(path))
+
+    def _make_directory(self):
+        directory = os.path.dirname(self.prefix)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _close_segment(self):
+        if self.records is not None:
+            self.records.flush()
+            self.header.base.flush()
+        self.header = None
+        self.records = None
+
+    def close(self):
+        self._close_segment()
+        with self.lock:
+            if self.events is not None:
+                self.events.close()
+            self.events = None
+            self.closed = True
+
+
+class ImageWriter(object):
+    '''Encodes and writes images on a pool of background threads.
+
+    `submit` copies the frame (the caller usually reuses it for the next
+    image) and returns right away. If all `max_queue` places are taken it
+    either waits for a free one (`block=True`) or drops the image. The
+    latency from `submit` until the file is written is kept for the last
+    `n_latencies` images, see `stats`.
+    '''
+
+    def __init__(self, n_workers=2, max_queue=8, block=False, color_space=13, n_latencies=100):
+        self.block = block
+        self.color_space = color_space
+        self.queue = queue.Queue(max_queue)
+
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.latencies = collections.deque(maxlen=n_latencies)
+        self.lock = threading.Lock()
+
+        self.workers = []
+        for _ in range(n_workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, frame, path, copy=True):
+        '''Queues the frame to be written to `path`, returns False if it was dropped.'''
+        if copy:
+            frame = frame.copy()
+        try:
+            self.queue.put((frame, path, time.time()), self.block)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+        with self.lock:
+            self.submitted += 1
+        return True
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+
+            frame, path, submitted = job
+            if self.color_space == kYUV422ColorSpace:
+                frame = YUV422ToBGR(frame)
+            ok = cv2.imwrite(path, frame)
+
+            with self.lock:
+                if ok:
+                    self.written += 1
+                    self.latencies.append(time.time() - submitted)
+                else:
+                    self.failed += 1
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            stats = {'submitted': self.submitted,
+                     'written': self.written,
+                     'dropped': self.dropped,
+                     'failed': self.failed}
+        if latencies:
+            stats['mean_latency'] = sum(latencies) / len(latencies)
+            stats['max_latency'] = max(latencies)
+        return stats
+
+    def close(self):
+        '''Writes the queued images and stops the threads.'''
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+
+class FrameHistory(object):
+    '''Keeps the last frames to save a burst around a trigger, e.g. a touch.
+
+    `push` copies every frame into one of `n_before + 1` preallocated slots,
+    so keeping the history allocates nothing per frame. After `trigger`
+    (which may be called from another thread) the next pushed frame, the
+    `n_before` frames before it and the `n_after` frames after it are handed
+    to the `writer` (an `ImageWriter`) and saved in the background as
+    <directory>/burst_<burst>_<offset to the trigger frame>.jpg.
+    '''
+
+    def __init__(self, writer, directory, n_before=5, n_after=5):
+        self.writer = writer
+        self.directory = directory
+        self.n_before = n_before
+        self.n_after = n_after
+
+        self.n_slots = n_before + 1
+        self.frames = None
+        self.timestamps = np.zeros((self.n_slots, 2), dtype=np.int64)
+        self.count = 0
+
+        self.pending = 0
+        self.remaining = 0
+        self.burst = -1
+        self.lock = threading.Lock()
+
+    def trigger(self):
+        with self.lock:
+            self.pending += 1
+
+    def push(self, frame, seconds, microseconds):
+        # (re)allocate on first pass or if the image format has changed
+        if self.frames is None or self.frames.shape[1:] != frame.shape:
+            self.frames = np.empty((self.n_slots,) + frame.shape, dtype=np.uint8)
+            self.count = 0
+
+        slot = self.count % self.n_slots
+        np.copyto(self.frames[slot], frame)
+        self.timestamps[slot] = seconds, microseconds
+        self.count += 1
+
+        if self.remaining > 0:
+            self._save(slot, self.n_after - self.remaining + 1)
+            self.remaining -= 1
+            return
+
+        with self.lock:
+            if self.pending == 0:
+                return
+            self.pending -= 1
+
+        # the burst starts: this frame and the ones before it
+        self.burst += 1
+        for offset in range(-min(self.n_before, self.count - 1), 1):
+            self._save((self.count - 1 + offset) % self.n_slots, offset)
+        self.remaining = self.n_after
+
+    def _save(self, slot, offset):
+        name = 'burst_{:04d}_{:+03d}.jpg'.format(self.burst, offset)
+        self.writer.submit(self.frames[slot], os.path.join(self.directory, name))
+
+
+def ExportJPEG(prefix, out_dir):
+    '''Writes every recorded frame as a JPEG file named after its timestamp.'''
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    n_images = 0
+    for path in RecordingSegments(prefix):
+        header, records = OpenSegment(path)
+        for record in records:
+            frame = record['frame']
+            if header['color_space'] == kYUV422ColorSpace:
+                frame = YUV422ToBGR(frame)
+            name = 'image_{}_{:06d}.jpg'.format(record['seconds'], record['microseconds'])
+            cv2.imwrite(os.path.join(out_dir, name), frame)
+            n_images += 1
+
+    return n_images
+
+
+if __name__ == "__main__":
+    '''Exporting a recording as JPEG images'''
+
+    parser = argparse.ArgumentParser(description="Export recorded NAO images")
+    parser.add_argument('prefix', type=str,
+                        help='Prefix of the segment files, e.g. ./session for ./session_0000.frames, ...')
+    parser.add_argument('--out_dir', type=str, default='./saved_images',
+                        help='Directory in which the JPEG images are saved.')
+
+    args = parser.parse_args()
+
+    n_images = ExportJPEG(args.prefix, args.out_dir)
+    print("exported {} images to {}".format(n_images, args.out_dir))
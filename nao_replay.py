@@ -0,0 +1,293 @@
+import time
+
+from nao_recorder import RecordingSegments, OpenSegment, ReadEvents
+
+
+def Timestamp(record):
+    return record['seconds'] + record['microseconds'] * 1e-6
+
+
+class EndOfReplay(Exception):
+    '''Raised by `getImageRemote` once all recorded frames have been served.'''
+    pass
+
+
+# the tactile events are also readable as sensor values through getData
+TOUCH_KEYS = {'Device/SubDeviceList/Head/Touch/Front/Sensor/Value': 'FrontTactilTouched',
+              'Device/SubDeviceList/Head/Touch/Middle/Sensor/Value': 'MiddleTactilTouched',
+              'Device/SubDeviceList/Head/Touch/Rear/Sensor/Value': 'RearTactilTouched'}
+
+# the measured head angles are those of the ReplayMotion
+JOINT_KEYS = {'Device/SubDeviceList/HeadYaw/Position/Sensor/Value': 'HeadYaw',
+              'Device/SubDeviceList/HeadPitch/Position/Sensor/Value': 'HeadPitch'}
+
+
+class ReplayMemory(object):
+    '''Stands in for ALMemory and raises the recorded events.
+
+    The events are raised by the video device as soon as it serves the first
+    frame recorded after them, the callbacks run on the thread that retrieves
+    the images, so the replay is deterministic. Modules passed by name to
+    `subscribeToEvent` have to be registered with `register_module` first.
+    The head angles are read from `motion` (a ReplayMotion), `getTimestamp`
+    returns the timestamp of the frame served last.
+    '''
+
+    def __init__(self, events=(), motion=None):
+        self.events = list(events)
+        self.next_event = 0
+        self.motion = motion
+        self.timestamp = (0, 0)
+        self.data = {}
+        self.modules = {}
+        self.subscribers = {}
+
+    def register_module(self, name, module):
+        self.modules[name] = module
+
+    def subscribeToEvent(self, name, module, callback):
+        self.subscribers[(name, module)] = callback
+
+    def unsubscribeToEvent(self, name, module):
+        self.subscribers.pop((name, module), None)
+
+    def getData(self, key):
+        if self.motion is not None and key in JOINT_KEYS:
+            return self.motion.angles.get(JOINT_KEYS[key], 0.0)
+        return self.data.get(TOUCH_KEYS.get(key, key), 0.0)
+
+    def getTimestamp(self, key):
+        return [self.getData(key), self.timestamp[0], self.timestamp[1]]
+
+    def insertData(self, key, value):
+        self.data[key] = value
+
+    def raiseEvent(self, name, value):
+        self.data[name] = value
+        for (event, module), callback in list(self.subscribers.items()):
+            if event == name:
+                module = self.modules.get(module, module)
+                getattr(module, callback)(name, value, None)
+
+    def advance(self, timestamp):
+        '''Raises all events recorded up to `timestamp` (seconds, microseconds).'''
+        self.timestamp = timestamp
+        while self.next_event < len(self.events) and self.events[self.next_event][:2] <= timestamp:
+            seconds, microseconds, name, value = self.events[self.next_event]
+            self.next_event += 1
+            self.raiseEvent(name, value)
+
+
+class ReplayVideoDevice(object):
+    '''Stands in for ALVideoDevice and serves the frames of a recording.
+
+    By default every call to `getImageRemote` returns the next recorded frame,
+    which measures how fast the processing can go. With `realtime` the frames
+    are served at the recorded pace: the call waits for the next frame and
+    frames the caller was too slow for are skipped, like with the robot.
+    Once the recording is exhausted `EndOfReplay` is raised, unless `loop` is
+    set. `stats` reports the number of served and skipped frames and the
+    achieved frame rate. A recording holds the images of one camera, there
+    is no `subscribeCameras`.
+    '''
+
+    def __init__(self, prefix, memory=None, realtime=False, loop=False):
+        self.segments = RecordingSegments(prefix)
+        if not self.segments:
+            raise IOError('no recording found for {}'.format(prefix))
+
+        self.memory = memory
+        self.realtime = realtime
+        self.loop = loop
+
+        self.records = self._records()
+        self.lookahead = None
+        self.subscribers = set()
+
+        self.served = 0
+        self.skipped = 0
+        self.start = None
+        self.first_timestamp = None
+
+    def _records(self):
+        while True:
+            for path in self.segments:
+                header, records = OpenSegment(path)
+                for record in records:
+                    yield header, record
+            if not self.loop:
+                return
+            # start the clock again for the next round
+            self.start = None
+
+    def subscribeCamera(self, name, camera_index, resolution, color_space, fps):
+        header, _ = OpenSegment(self.segments[0])
+        if color_space != header['color_space']:
+            print('the recording uses color space {}, not {}'.format(header['color_space'], color_space))
+        self.subscribers.add(name)
+        return name
+
+    def unsubscribe(self, nameID):
+        self.subscribers.discard(nameID)
+        return True
+
+    def _peek(self):
+        if self.lookahead is None:
+            for item in self.records:
+                self.lookahead = item
+                break
+        return self.lookahead
+
+    def _next(self):
+        item = self._peek()
+        if item is None:
+            raise EndOfReplay('served all {} frames'.format(self.served))
+        self.lookahead = None
+        return item
+
+    def getImageRemote(self, nameID):
+        header, record = self._next()
+
+        if self.start is None:
+            self.start = time.time()
+            self.first_timestamp = Timestamp(record)
+
+        if self.realtime:
+            # skip the frames that would have been replaced by now ...
+            now = time.time() - self.start
+            while True:
+                upcoming = self._peek()
+                if upcoming is None or self.start is None or Timestamp(upcoming[1]) - self.first_timestamp > now:
+                    break
+                header, record = self._next()
+                self.skipped += 1
+
+            # ... and wait for the frame if it is not due yet
+            if self.start is not None:
+                delay = (Timestamp(record) - self.first_timestamp) - (time.time() - self.start)
+                if delay > 0.0:
+                    time.sleep(delay)
+
+        seconds, microseconds = int(record['seconds']), int(record['microseconds'])
+        if self.memory is not None:
+            self.memory.advance((seconds, microseconds))
+
+        self.served += 1
+        frame = record['frame']
+        height, width, nchannels = frame.shape
+        return [width, height, nchannels, int(header['color_space']),
+                seconds, microseconds, frame.tobytes(), 0]
+
+    def stats(self):
+        elapsed = time.time() - self.start if self.start is not None else 0.0
+        return {'served': self.served,
+                'skipped': self.skipped,
+                'elapsed': elapsed,
+                'fps': self.served / elapsed if elapsed > 0.0 else 0.0}
+
+
+class ReplayJob(object):
+    '''Stands in for the `post` attribute of a proxy, every call finishes immediately.'''
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def __getattr__(self, name):
+        method = getattr(self.proxy, name)
+
+        def run(*args):
+            method(*args)
+            self.proxy.job_id += 1
+            return self.proxy.job_id
+        return run
+
+
+class ReplayProxy(object):
+    '''Accepts and counts every call, e.g. for ALTextToSpeech or ALLeds.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.job_id = 0
+        self.calls = {}
+        self.post = ReplayJob(self)
+
+    def isRunning(self, job_id):
+        return False
+
+    def stop(self, job_id):
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def call(*args):
+            self.calls[name] = self.calls.get(name, 0) + 1
+        return call
+
+
+class ReplayMotion(ReplayProxy):
+    '''Stands in for ALMotion, the joints reach their targets immediately.'''
+
+    def __init__(self, name='ALMotion'):
+        ReplayProxy.__init__(self, name)
+        self.angles = {'HeadYaw': 0.0, 'HeadPitch': 0.0}
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _names(self, names):
+        if names == 'Head':
+            return ['HeadYaw', 'HeadPitch']
+        if isinstance(names, str):
+            return [names]
+        return names
+
+    def _values(self, names, values):
+        if not isinstance(values, (list, tuple)):
+            values = [values] * len(names)
+        return values
+
+    def setAngles(self, names, angles, fractionMaxSpeed):
+        self._count('setAngles')
+        names = self._names(names)
+        for name, angle in zip(names, self._values(names, angles)):
+            self.angles[name] = angle
+
+    def changeAngles(self, names, changes, fractionMaxSpeed):
+        self._count('changeAngles')
+        names = self._names(names)
+        for name, change in zip(names, self._values(names, changes)):
+            self.angles[name] = self.angles.get(name, 0.0) + change
+
+    def getAngles(self, names, useSensors):
+        self._count('getAngles')
+        return [self.angles.get(name, 0.0) for name in self._names(names)]
+
+
+class ReplaySession(object):
+    '''Replaces the proxies to the robot with a recorded session.
+
+    `ALProxy` has the same signature as naoqi's ALProxy (the IP and port are
+    ignored), so a script can be replayed by rebinding the name:
+
+        replay = ReplaySession('./session')
+        ALProxy = replay.ALProxy
+    '''
+
+    def __init__(self, prefix, realtime=False, loop=False):
+        motion = ReplayMotion()
+        self.memory = ReplayMemory(ReadEvents(prefix), motion)
+        self.proxies = {'ALMemory': self.memory,
+                        'ALVideoDevice': ReplayVideoDevice(prefix, self.memory, realtime, loop),
+                        'ALMotion': motion}
+
+    def ALProxy(self, name, ip=None, port=None):
+        if name not in self.proxies:
+            self.proxies[name] = ReplayProxy(name)
+        return self.proxies[name]
+
+    def stats(self):
+        stats = self.proxies['ALVideoDevice'].stats()
+        stats['motion_calls'] = dict(self.proxies['ALMotion'].calls)
+        return stats
@@ -0,0 +1,667 @@
+import math
+import threading
+import time
+import numpy as np
+
+# field of view of NAO's cameras (both have the same), in radians
+HORIZONTAL_FOV = math.radians(60.97)
+VERTICAL_FOV = math.radians(47.64)
+
+# the range of HeadPitch depends on HeadYaw, so the head does not hit the shoulders
+# (NAO documentation, head joints): HeadYaw, lowest and highest HeadPitch in degrees,
+# linear in between
+HEAD_LIMITS = np.radians([[-119.52, -25.73, 18.91],
+                          [-87.49, -18.91, 11.46],
+                          [-62.45, -24.64, 17.19],
+                          [-51.74, -27.50, 18.91],
+                          [-43.32, -31.40, 21.20],
+                          [-27.85, -38.50, 24.18],
+                          [0.0, -38.50, 29.51],
+                          [27.85, -38.50, 24.18],
+                          [43.32, -31.40, 21.20],
+                          [51.74, -27.50, 18.91],
+                          [62.45, -24.64, 17.19],
+                          [87.49, -18.91, 11.46],
+                          [119.52, -25.73, 18.91]])
+
+
+def ClampHeadAngles(angles):
+    '''Clamps [yaw, pitch] (radians) to the joint limits of the head.
+
+    Returns the clamped angles and for each joint the limit it was clamped
+    to: -1 the lower one, 1 the upper one, 0 none. The pitch limits are
+    interpolated from HEAD_LIMITS at the clamped yaw.
+    '''
+    yaw, pitch = angles
+    yaw_limit = -1 if yaw < HEAD_LIMITS[0, 0] else 1 if yaw > HEAD_LIMITS[-1, 0] else 0
+    yaw = min(max(yaw, HEAD_LIMITS[0, 0]), HEAD_LIMITS[-1, 0])
+
+    lowest = np.interp(yaw, HEAD_LIMITS[:, 0], HEAD_LIMITS[:, 1])
+    highest = np.interp(yaw, HEAD_LIMITS[:, 0], HEAD_LIMITS[:, 2])
+    pitch_limit = -1 if pitch < lowest else 1 if pitch > highest else 0
+    pitch = min(max(pitch, lowest), highest)
+
+    return [float(yaw), float(pitch)], (yaw_limit, pitch_limit)
+
+
+def PixelToAngles(point, image_size):
+    '''Yaw and pitch (radians) of the ray through a pixel, relative to the optical axis.
+
+    A pinhole model whose focal lengths follow from the field of view, so it
+    holds for every resolution. The signs match the head joints: a point
+    left of the middle has a positive yaw, a point below the middle a
+    positive pitch (NAO's pitch points down).
+    '''
+    width, height = image_size
+    focal_x = (width / 2.0) / math.tan(HORIZONTAL_FOV / 2.0)
+    focal_y = (height / 2.0) / math.tan(VERTICAL_FOV / 2.0)
+    yaw = -math.atan((point[0] - width / 2.0) / focal_x)
+    pitch = math.atan((point[1] - height / 2.0) / focal_y)
+    return yaw, pitch
+
+
+class BallTracker(object):
+    '''Constant velocity Kalman filter on the ball center in the image.
+
+    The state holds the position and velocity (pixels and pixels per second)
+    of both image axes, which share the same motion model and therefore the
+    same 2 x 2 covariance. `process_noise` is the spectral density of the
+    acceleration (pixels^2 / s^3) and `measurement_noise` the variance of a
+    detected center (pixels^2).
+
+    Every frame the loop calls `predict` with the timestamp of the frame, and
+    only if `due` returns True it runs the detection and passes the center
+    (or None) to `correct`. The detection interval adapts to the innovation,
+    i.e. how far the detected center is from the predicted one: below
+    `low_innovation` pixels the interval grows by one frame (up to
+    `max_interval`), above `high_innovation` or on a missed detection it
+    drops back to every frame. Without a detection for `max_coast` seconds
+    the ball is lost and the estimate is None.
+    '''
+
+    def __init__(self, process_noise=1e5, measurement_noise=4.0, max_interval=4,
+                 low_innovation=3.0, high_innovation=10.0, max_coast=0.5):
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.max_interval = max_interval
+        self.low_innovation = low_innovation
+        self.high_innovation = high_innovation
+        self.max_coast = max_coast
+
+        self.state = None       # [[x, y], [vx, vy]]
+        self.covariance = None
+        self.time = None
+        self.last_measurement = None
+
+        self.interval = 1
+        self.since_detection = 0
+        self.innovation = None
+
+        self.detections = 0
+        self.skipped = 0
+        self.misses = 0
+
+    @property
+    def center(self):
+        '''Estimated center of the ball (integer pixels) or None.'''
+        if self.state is None:
+            return None
+        return int(round(self.state[0, 0])), int(round(self.state[0, 1]))
+
+    @property
+    def velocity(self):
+        if self.state is None:
+            return None
+        return self.state[1, 0], self.state[1, 1]
+
+    def predict(self, timestamp):
+        '''Moves the estimate to the time of the frame (in seconds), returns the predicted center.'''
+        if self.state is not None:
+            dt = max(0.0, timestamp - self.time)
+            if timestamp - self.last_measurement > self.max_coast:
+                # no detection for too long, the ball is lost
+                self.state = None
+            else:
+                transition = np.array([[1.0, dt], [0.0, 1.0]])
+                # white noise acceleration
+                noise = self.process_noise * np.array([[dt ** 3 / 3.0, dt ** 2 / 2.0],
+                                                       [dt ** 2 / 2.0, dt]])
+                self.state = transition.dot(self.state)
+                self.covariance = transition.dot(self.covariance).dot(transition.T) + noise
+        self.time = timestamp
+        self.since_detection += 1
+        return self.center
+
+    def due(self):
+        '''Whether the detection should run on this frame.'''
+        if self.state is None or self.since_detection >= self.interval:
+            return True
+        self.skipped += 1
+        return False
+
+    def correct(self, center):
+        '''Updates the estimate with the detected center (None if it was not found), returns the center.'''
+        self.since_detection = 0
+        self.detections += 1
+
+        if center is None:
+            self.misses += 1
+            self.interval = 1
+            self.innovation = None
+            return self.center
+
+        measurement = np.array(center, dtype=np.float64)
+        self.last_measurement = self.time
+        if self.state is None:
+            # (re)initialize at the detected center, standing still
+            self.state = np.array([measurement, [0.0, 0.0]])
+            self.covariance = np.diag([self.measurement_noise, 1e4])
+            self.interval = 1
+            self.innovation = None
+            return self.center
+
+        residual = measurement - self.state[0]
+        gain = self.covariance[:, 0] / (self.covariance[0, 0] + self.measurement_noise)
+        self.state = self.state + np.outer(gain, residual)
+        self.covariance = self.covariance - np.outer(gain, self.covariance[0])
+
+        self.innovation = float(np.hypot(residual[0], residual[1]))
+        if self.innovation > self.high_innovation:
+            self.interval = 1
+        elif self.innovation < self.low_innovation:
+            self.interval = min(self.interval + 1, self.max_interval)
+
+        return self.center
+
+    def stats(self):
+        return {'detections': self.detections,
+                'skipped': self.skipped,
+                'misses': self.misses,
+                'interval': self.interval}
+
+
+class StepResponse(object):
+    '''Measures the response of the head to a step of the error.
+
+    A step starts when the ball is acquired or the error grows by more than
+    `min_step` (a fraction of the image width) from one sample to the next. For the last step it keeps
+    the rise time (until the error is down to 10 % of the step), the
+    overshoot (how far the error went past zero, relative to the step) and
+    the settling time (until the error stays within 5 % of the step).
+    '''
+
+    def __init__(self, min_step=0.1):
+        self.min_step = min_step
+        self.steps = 0
+        self.start = None
+        self.initial = None
+        self.previous = None
+        self.rise_time = None
+        self.settling_time = None
+        self.overshoot = 0.0
+
+    def add(self, timestamp, error):
+        '''Adds the error (x, y) at the time (in seconds), None while there is no ball.'''
+        if error is None:
+            self.previous = None
+            return
+        error = np.asarray(error, dtype=np.float64)
+        if self.previous is None or np.hypot(*error) - np.hypot(*self.previous) > self.min_step:
+            self.steps += 1
+            self.start = timestamp
+            self.initial = error
+            self.rise_time = None
+            self.settling_time = None
+            self.overshoot = 0.0
+        self.previous = error
+
+        size = np.hypot(*self.initial)
+        if size == 0.0:
+            return
+        remaining = np.hypot(*error) / size
+        if self.rise_time is None and remaining <= 0.1:
+            self.rise_time = timestamp - self.start
+        # the part of the error beyond zero, in the direction of the step
+        self.overshoot = max(self.overshoot, float(-error.dot(self.initial) / size ** 2))
+        if remaining > 0.05:
+            self.settling_time = None
+        elif self.settling_time is None:
+            self.settling_time = timestamp - self.start
+
+    def metrics(self):
+        return {'steps': self.steps,
+                'rise_time': self.rise_time,
+                'settling_time': self.settling_time,
+                'overshoot': self.overshoot}
+
+
+class HeadController(threading.Thread):
+    '''Points the head at the ball from its own thread, at a fixed rate.
+
+    The vision loop only hands over the newest ball center with `update`,
+    `rate` times per second the controller reads it and sends one
+    `changeAngles` for HeadYaw and HeadPitch. The error is the offset of the
+    center from the middle of the image as a fraction of the image width,
+    the PID output is the angular velocity of the head (rad/s per unit of
+    error, `kp`, `ki` and `kd`), integrated over one period into the angle
+    change, at most `max_speed` rad/s. A center older than `timeout`
+    seconds is not used and the integral is reset, so the head stops when
+    the ball is lost.
+
+    The controller keeps track of the head angles it commanded (read from
+    the sensors when the ball is acquired) and clamps the targets to the
+    joint limits (see `ClampHeadAngles`) before anything is sent. Where a
+    joint is at its limit (`limits`), the integral of that axis is reset
+    and no change is sent that pushes further into it.
+
+    Given the head angles the image was taken at (see `HeadAngleHistory`),
+    the ball is located in head angles with `PixelToAngles` and the error is
+    the difference to the commanded angles (in the same units as above,
+    divided by the horizontal field of view). This error does not depend on
+    how far the head has moved since the image was taken, so the latency of
+    the images does not make the head overshoot at high gains.
+
+    `tuning` holds the parameters, `response` measures the step responses
+    (see `StepResponse`).
+    '''
+
+    def __init__(self, motionProxy, rate=20.0, kp=6.0, ki=0.0, kd=0.3, max_speed=2.0,
+                 timeout=0.5, fractionMaxSpeed=0.3, joint_names=("HeadYaw", "HeadPitch")):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.motionProxy = motionProxy
+        self.joint_names = list(joint_names)
+        self.rate = rate
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.max_speed = max_speed
+        self.timeout = timeout
+        self.fractionMaxSpeed = fractionMaxSpeed
+
+        self.center = None
+        self.image_size = None
+        self.head_angles = None
+        self.received = None
+
+        self.integral = np.zeros(2)
+        self.previous = None
+        self.response = StepResponse()
+        self.angles = None
+        self.limits = (0, 0)
+
+        self.commands = 0
+        self.ticks = 0
+        self.late = 0
+
+        self.lock = threading.Lock()
+        self.running = True
+
+    @property
+    def tuning(self):
+        return {'rate': self.rate,
+                'kp': self.kp,
+                'ki': self.ki,
+                'kd': self.kd,
+                'max_speed': self.max_speed,
+                'timeout': self.timeout}
+
+    def update(self, center, image_size, head_angles=None):
+        '''Hands over the newest center of the ball (or None) in an image of `image_size` (width, height).
+
+        `head_angles` are the angles [yaw, pitch] of the head when the image was taken, if known.
+        '''
+        with self.lock:
+            self.center = center
+            self.image_size = image_size
+            self.head_angles = head_angles
+            self.received = time.time()
+
+    def error(self):
+        '''The current error (x, y) as a fraction of the image width, None without a recent center.'''
+        with self.lock:
+            center, image_size, head_angles, received = self.center, self.image_size, self.head_angles, self.received
+        if center is None or time.time() - received > self.timeout:
+            return None
+
+        if head_angles is None:
+            width, height = image_size
+            return np.array([(center[0] - width / 2.0) / width, (center[1] - height / 2.0) / width])
+
+        # where the ball is in head angles, compared to where the head is sent
+        if self.angles is None:
+            self.angles = self.motionProxy.getAngles(self.joint_names, True)
+        yaw, pitch = PixelToAngles(center, image_size)
+        return np.array([-(head_angles[0] + yaw - self.angles[0]) / HORIZONTAL_FOV,
+                         (head_angles[1] + pitch - self.angles[1]) / HORIZONTAL_FOV])
+
+    def step(self, dt):
+        '''One period of the controller, returns the angle changes or None.'''
+        now = time.time()
+        error = self.error()
+        self.response.add(now, error)
+        if error is None:
+            self.integral[:] = 0.0
+            self.previous = None
+            self.angles = None
+            return None
+        if self.angles is None:
+            self.angles = self.motionProxy.getAngles(self.joint_names, True)
+
+        self.integral += error * dt
+        derivative = (error - self.previous) / dt if self.previous is not None else np.zeros(2)
+        self.previous = error
+
+        speed = self.kp * error + self.ki * self.integral + self.kd * derivative
+        speed = np.clip(speed, -self.max_speed, self.max_speed)
+
+        # a ball right of the middle needs a negative yaw, below the middle a positive pitch
+        target = [self.angles[0] - speed[0] * dt, self.angles[1] + speed[1] * dt]
+        target, self.limits = ClampHeadAngles(target)
+        for axis in range(2):
+            if self.limits[axis] != 0:
+                # pushing into the limit, stop integrating
+                self.integral[axis] = 0.0
+        changes = [target[0] - self.angles[0], target[1] - self.angles[1]]
+        if changes == [0.0, 0.0]:
+            return None
+
+        self.motionProxy.changeAngles(self.joint_names, changes, self.fractionMaxSpeed)
+        self.angles = target
+        self.commands += 1
+        return changes
+
+    def run(self):
+        period = 1.0 / self.rate
+        next_tick = time.time()
+        while self.running:
+            self.step(period)
+            self.ticks += 1
+
+            next_tick += period
+            delay = next_tick - time.time()
+            if delay > 0.0:
+                time.sleep(delay)
+            else:
+                # the call took longer than a period, skip the missed ticks
+                self.late += 1
+                next_tick = time.time()
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def stats(self):
+        stats = {'ticks': self.ticks,
+                 'commands': self.commands,
+                 'late': self.late}
+        stats.update(self.response.metrics())
+        return stats
+
+
+class Gaze(object):
+    '''Turns the head towards a point of the image with one absolute command.
+
+    `look_at` reads the current head angles from the sensors, adds the angles
+    of the point from `PixelToAngles` and sends the sum with a single
+    `setAngles`, so the head goes straight to the ball instead of creeping
+    towards it with a change per frame. The pitch of the camera mount does
+    not matter, the angles are relative to the optical axis.
+
+    An image taken while the head is still turning shows the ball where it
+    was for an older head angle, adding it to the current angle would send
+    the head too far. Hence a new target is only sent once the head is
+    within `tolerance` (radians) of the last one and has stayed there for
+    `settle_time` seconds, and only if it differs from the last one by more
+    than `tolerance`. `skipped` counts the points that were not sent. The
+    target is clamped to the joint limits, `limits` tells which were hit.
+    '''
+
+    def __init__(self, motionProxy, fractionMaxSpeed=0.2, tolerance=0.02, settle_time=0.1,
+                 joint_names=("HeadYaw", "HeadPitch")):
+        self.motionProxy = motionProxy
+        self.fractionMaxSpeed = fractionMaxSpeed
+        self.tolerance = tolerance
+        self.settle_time = settle_time
+        self.joint_names = list(joint_names)
+
+        self.target = None
+        self.arrived = None
+        self.limits = (0, 0)
+
+        self.commands = 0
+        self.skipped = 0
+
+    def settled(self, head_angles):
+        '''Whether the head reached the last target at least `settle_time` ago.'''
+        if self.target is None:
+            return True
+        if max(abs(head_angles[0] - self.target[0]), abs(head_angles[1] - self.target[1])) > self.tolerance:
+            self.arrived = None
+            return False
+        if self.arrived is None:
+            self.arrived = time.time()
+        return time.time() - self.arrived >= self.settle_time
+
+    def look_at(self, point, image_size, head_angles=None):
+        '''Sends the head to the point, returns the new target [yaw, pitch] or None if nothing was sent.
+
+        `head_angles` are the angles the image was taken at. Without them the
+        current ones are read from the sensors and the head has to be settled.
+        '''
+        if head_angles is None:
+            head_angles = self.motionProxy.getAngles(self.joint_names, True)
+            if not self.settled(head_angles):
+                self.skipped += 1
+                return None
+
+        yaw, pitch = PixelToAngles(point, image_size)
+        target, self.limits = ClampHeadAngles([head_angles[0] + yaw, head_angles[1] + pitch])
+        if (self.target is not None and
+                max(abs(target[0] - self.target[0]), abs(target[1] - self.target[1])) <= self.tolerance):
+            self.skipped += 1
+            return None
+
+        self.target = target
+        self.arrived = None
+        self.motionProxy.setAngles(self.joint_names, target, self.fractionMaxSpeed)
+        self.commands += 1
+        return target
+
+
+class MotionCommander(object):
+    '''Stands in for ALMotion and coalesces the head commands.
+
+    `setAngles` and `changeAngles` for the head joints are not sent right
+    away but become the pending command: a newer target replaces a pending
+    one, changes are added up (onto a pending target as well). The pending
+    command is sent with `post`, so the call does not wait for the motion,
+    but at most every `min_interval` seconds, and not at all while it is
+    within `deadband` (radians) of the last target or the changes add up to
+    less than that. A new `post.setAngles` for the same joints replaces the
+    motion still in progress on the robot, so at most one head job is ever
+    outstanding, its id is `job`. Calls the loop makes anyway (e.g. every
+    frame) send a due command, `flush` does it explicitly. Other calls and
+    other joints go straight to `motionProxy`. `stats` reports how many
+    requests were saved.
+    '''
+
+    def __init__(self, motionProxy, deadband=0.01, min_interval=0.05, joint_names=("HeadYaw", "HeadPitch")):
+        self.motionProxy = motionProxy
+        self.deadband = deadband
+        self.min_interval = min_interval
+        self.joint_names = list(joint_names)
+
+        self.target = None          # pending absolute target
+        self.changes = None         # pending relative changes
+        self.fractionMaxSpeed = None
+        self.sent = None            # last absolute target sent
+        self.sent_time = None
+        self.job = None
+
+        self.requests = 0
+        self.commands = 0
+        self.suppressed = 0
+        self.merged = 0
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.motionProxy, name)
+
+    def _head(self, names):
+        return list(names) == self.joint_names
+
+    def setAngles(self, names, angles, fractionMaxSpeed):
+        if not self._head(names):
+            return self.motionProxy.setAngles(names, angles, fractionMaxSpeed)
+        self.requests += 1
+        if self.target is not None or self.changes is not None:
+            self.merged += 1
+        self.target = list(angles)
+        self.changes = None
+        self.fractionMaxSpeed = fractionMaxSpeed
+        self.flush()
+
+    def changeAngles(self, names, changes, fractionMaxSpeed):
+        if not self._head(names):
+            return self.motionProxy.changeAngles(names, changes, fractionMaxSpeed)
+        self.requests += 1
+        self.fractionMaxSpeed = fractionMaxSpeed
+        if self.target is not None:
+            self.merged += 1
+            self.target = [angle + change for angle, change in zip(self.target, changes)]
+        elif self.changes is not None:
+            self.merged += 1
+            self.changes = [total + change for total, change in zip(self.changes, changes)]
+        else:
+            self.changes = list(changes)
+        self.flush()
+
+    def flush(self, force=False):
+        '''Sends the pending command if it is due, returns whether it was sent.'''
+        if self.target is None and self.changes is None:
+            return False
+
+        # within the deadband: dropped (a target) or kept adding up (changes)
+        if self.target is not None and self.sent is not None:
+            if max(abs(angle - sent) for angle, sent in zip(self.target, self.sent)) < self.deadband:
+                self.suppressed += 1
+                self.target = None
+                return False
+        if self.changes is not None and max(abs(change) for change in self.changes) < self.deadband:
+            return False
+
+        now = time.time()
+        if not force and self.sent_time is not None and now - self.sent_time < self.min_interval:
+            return False
+
+        if self.target is not None:
+            self.job = self.motionProxy.post.setAngles(self.joint_names, self.target, self.fractionMaxSpeed)
+            self.sent = self.target
+        else:
+            self.job = self.motionProxy.post.changeAngles(self.joint_names, self.changes, self.fractionMaxSpeed)
+            if self.sent is not None:
+                self.sent = [sent + change for sent, change in zip(self.sent, self.changes)]
+        self.target = None
+        self.changes = None
+        self.sent_time = now
+        self.commands += 1
+        return True
+
+    def stats(self):
+        return {'requests': self.requests,
+                'commands': self.commands,
+                'saved': self.requests - self.commands,
+                'suppressed': self.suppressed,
+                'merged': self.merged}
+
+
+# ALMemory keys of the measured head angles
+HEAD_SENSOR_KEYS = ("Device/SubDeviceList/HeadYaw/Position/Sensor/Value",
+                    "Device/SubDeviceList/HeadPitch/Position/Sensor/Value")
+
+
+class HeadAngleHistory(threading.Thread):
+    '''Samples the head angles on its own thread and keeps them for a while.
+
+    `rate` times per second the measured angles are read from ALMemory with
+    `getTimestamp`, which also returns when the value was measured, in the
+    clock of the robot that also timestamps the images (naoImage[4] and
+    naoImage[5]). They are kept in a ring of `duration` seconds and
+    `angles_at` interpolates them at the time an image was taken: the
+    position of the ball in that image is relative to the head pose at that
+    moment, not to the pose once the detection is done.
+
+    A sample costs one call per joint, so the rate is kept low (the head
+    moves smoothly between the samples). The two calls need not fall into
+    the same sensor cycle, each joint keeps its own timestamps and is
+    interpolated on them.
+    '''
+
+    def __init__(self, memProxy, rate=25.0, duration=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.memProxy = memProxy
+        self.rate = rate
+
+        n_samples = max(2, int(rate * duration))
+        self.times = np.zeros((n_samples, 2))
+        self.angles = np.zeros((n_samples, 2))
+        self.count = 0
+
+        self.lock = threading.Lock()
+        self.running = True
+
+    def record(self, timestamp, angles):
+        '''Stores the angles [yaw, pitch] measured at the time (in seconds, or one time per joint).'''
+        with self.lock:
+            slot = self.count % len(self.times)
+            self.times[slot] = timestamp
+            self.angles[slot] = angles
+            self.count += 1
+
+    def angles_at(self, timestamp):
+        '''The head angles [yaw, pitch] at the time, None before the first sample.'''
+        with self.lock:
+            if self.count == 0:
+                return None
+            n_samples = min(self.count, len(self.times))
+            # oldest sample first
+            order = np.arange(self.count - n_samples, self.count) % len(self.times)
+            times = self.times[order]
+            angles = self.angles[order]
+        return [float(np.interp(timestamp, times[:, 0], angles[:, 0])),
+                float(np.interp(timestamp, times[:, 1], angles[:, 1]))]
+
+    def sample(self):
+        angles = []
+        timestamps = []
+        for key in HEAD_SENSOR_KEYS:
+            angle, seconds, microseconds = self.memProxy.getTimestamp(key)
+            angles.append(angle)
+            timestamps.append(seconds + microseconds * 1e-6)
+        with self.lock:
+            if self.count > 0 and np.any(timestamps <= self.times[(self.count - 1) % len(self.times)]):
+                # not updated since the last sample
+                return
+        self.record(timestamps, angles)
+
+    def run(self):
+        period = 1.0 / self.rate
+        next_sample = time.time()
+        while self.running:
+            self.sample()
+
+            next_sample += period
+            delay = next_sample - time.time()
+            if delay > 0.0:
+                time.sleep(delay)
+            else:
+                next_sample = time.time()
+
+    def stop(self):
+        self.running = False
+        self.join()
@@ -0,0 +1,1241 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import time
+import traceback
+from timeit import default_timer as timer
+
+import cv2
+import numpy as np
+
+from nao_camera import kYUV422ColorSpace, YUV422ToHSV, YUV422ToBGR
+from nao_recorder import RecordingSegments, OpenSegment
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2, see PeakAllocation
+    tracemalloc = None
+
+# the stages of the ball detection in their usual order,
+# lut replaces hsv and threshold (see ColorLUT), components replaces contours (see Blobs)
+STAGES = ('blur', 'hsv', 'threshold', 'lut', 'erode', 'dilate', 'contours', 'components')
+# the blur used to be computed without being used, hence it is off by default
+DEFAULT_STAGES = ('hsv', 'threshold', 'erode', 'dilate', 'contours')
+# where ColorLUT keeps the compiled tables
+LUT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'nao_color_lut')
+
+
+def Buffer(buffers, name, shape, dtype=np.uint8):
+    '''Returns an array of `shape` from the store `buffers[name]`, which only grows.'''
+    size = int(np.prod(shape))
+    store = buffers.get(name)
+    if store is None or store.size < size or store.dtype != dtype:
+        store = np.empty(size, dtype=dtype)
+        buffers[name] = store
+    return store[:size].reshape(shape)
+
+
+def DrawBall(frame, center, circle, label=None):
+    '''Draws the enclosing circle and the center of a ball (and its label) on the frame.'''
+    (x, y), radius = circle
+    cv2.circle(frame, (int(x), int(y)), int(radius),
+               (0, 255, 255), 2)
+    cv2.circle(frame, center, 5, (0, 0, 255), -1)
+    if label is not None:
+        cv2.putText(frame, label, (int(x + radius), int(y - radius)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
+
+
+class StageTimer(object):
+    '''Accumulates the time spent in each stage.'''
+
+    def __init__(self):
+        self.total = {}
+        self.calls = {}
+        self.last = {}
+
+    def add(self, name, seconds):
+        self.total[name] = self.total.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.last[name] = seconds
+
+    def mean_ms(self):
+        '''Mean time per call of each stage in milliseconds.'''
+        return dict((name, 1000.0 * self.total[name] / self.calls[name]) for name in self.total)
+
+    def report(self):
+        mean = self.mean_ms()
+        lines = ['{:>18}: {:7.3f} ms'.format(name, mean[name]) for name in sorted(mean, key=mean.get, reverse=True)]
+        lines.append('{:>18}: {:7.3f} ms'.format('total', sum(mean.values())))
+        return '\n'.join(lines)
+
+
+class ColorLUT(object):
+    '''Classifies the colors of a BGR image with a precomputed lookup table.
+
+    The HSV ranges in `color_bounds` (name -> [lower, upper], at most 8
+    colors) are compiled once into a table over the BGR values quantized to
+    `bits` bits per channel (32 x 32 x 32 for 5 bits), bit k of an entry is
+    set if the center of that cell lies within the range of the k-th color
+    (in sorted order). Classifying an image is then a single lookup per
+    pixel instead of the conversion to HSV and `cv2.inRange`, the masks
+    differ only at the borders of the ranges by the quantization. The table
+    is cached in `cache_dir` by the bounds, the bits and `VERSION`, so it is
+    only computed once, and a table compiled by an older `compile` is never
+    loaded (bump `VERSION` when changing it or the layout). The cache file is renamed into place once it is complete, so processes that
+    start at the same time (see ParallelBallDetector) never load a partial
+    table, at worst each of them compiles its own.
+    '''
+
+    VERSION = 1
+
+    def __init__(self, color_bounds, bits=5, cache_dir=LUT_CACHE_DIR):
+        if len(color_bounds) > 8:
+            raise ValueError('at most 8 colors fit into the table, got {}'.format(len(color_bounds)))
+
+        self.names = sorted(color_bounds)
+        self.bounds = [(tuple(color_bounds[name][0]), tuple(color_bounds[name][1])) for name in self.names]
+        self.bits = bits
+
+        key = hashlib.md5(repr((self.VERSION, self.bounds, bits)).encode('utf-8')).hexdigest()
+        path = os.path.join(cache_dir, 'color_lut_{}.npy'.format(key)) if cache_dir else None
+        self.table = self.load(path)
+        if self.table is None:
+            self.table = self.compile()
+            if path is not None:
+                self.save(path)
+
+        # one table per color with 255 for the pixels of that color, i.e. the mask
+        self.masks = dict((name, np.where(self.table & (1 << k), 255, 0).astype(np.uint8))
+                          for k, name in enumerate(self.names))
+
+        self.quantize = (np.arange(256) >> (8 - bits)).astype(np.uint8)
+        # np.take converts any other index type to intp in a temporary array of 8 bytes per pixel
+        self.index_dtype = np.intp
+        self.buffers = {}
+
+    def load(self, path):
+        '''The cached table, or None if there is none (or it is broken).'''
+        if path is None or not os.path.isfile(path):
+            return None
+        try:
+            table = np.load(path)
+        except (IOError, ValueError, EOFError):
+            return None
+        if table.shape != ((1 << self.bits) ** 3,) or table.dtype != np.uint8:
+            return None
+        return table
+
+    def save(self, path):
+        '''Writes the table to a temporary file and renames it, so no one loads it half written.'''
+        cache_dir = os.path.dirname(path)
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # e.g. created by another worker in the meantime
+            if not os.path.isdir(cache_dir):
+                raise
+        fd, temp_path = tempfile.mkstemp(suffix='.npy', dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                np.save(stream, self.table)
+            os.rename(temp_path, path)
+        except OSError:
+            # e.g. on Windows if another worker renamed its table first
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+
+    def compile(self):
+        bits = self.bits
+        n_levels = 1 << bits
+        cells = np.arange(n_levels ** 3)
+
+        # the center of each cell, in the same order as the index of `lookup`
+        bgr = np.empty((cells.size, 1, 3), dtype=np.uint8)
+        for channel in range(3):
+            level = (cells >> (bits * (2 - channel))) & (n_levels - 1)
+            bgr[:, 0, channel] = (level << (8 - bits)) + (1 << (7 - bits))
+        hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
+
+        table = np.zeros(cells.size, dtype=np.uint8)
+        for k, (lower, upper) in enumerate(self.bounds):
+            inside = cv2.inRange(hsv, lower, upper)[:, 0] > 0
+            table[inside] |= 1 << k
+        return table
+
+    def lookup(self, frame, table, out=None):
+        height, width = frame.shape[:2]
+        quantized = Buffer(self.buffers, 'quantized', (height, width, 3))
+        index = Buffer(self.buffers, 'index', (height, width), self.index_dtype)
+        scratch = Buffer(self.buffers, 'scratch', (height, width), self.index_dtype)
+        if out is None:
+            out = np.empty((height, width), dtype=np.uint8)
+
+        # index = b << 2 * bits | g << bits | r, all in preallocated arrays
+        cv2.LUT(frame, self.quantize, dst=quantized)
+        # (copying casts without the buffers a ufunc uses to mix types)
+        np.copyto(index, quantized[:, :, 0])
+        np.left_shift(index, 2 * self.bits, out=index)
+        np.copyto(scratch, quantized[:, :, 1])
+        np.left_shift(scratch, self.bits, out=scratch)
+        np.bitwise_or(index, scratch, out=index)
+        np.copyto(scratch, quantized[:, :, 2])
+        np.bitwise_or(index, scratch, out=index)
+
+        # the index is always within the table, and unlike 'raise' 'clip' writes into `out` without a copy
+        return np.take(table, index, out=out, mode='clip')
+
+    def classify(self, frame, name, out=None):
+        '''Mask of the pixels of the color `name` (255 inside, 0 outside).'''
+        return self.lookup(frame, self.masks[name], out)
+
+    def labels(self, frame, out=None):
+        '''Bit k of each pixel is set if it has the k-th color of `names`.'''
+        return self.lookup(frame, self.table, out)
+
+
+class Blobs(object):
+    '''The blobs of a mask, found with a single connected components pass.
+
+    `areas`, `centroids` (x, y), `boxes` (x, y, width, height) and `radii`
+    (the radius of a circle with the same area) hold one entry per blob, the
+    background is not included. `labels` is the image of the blob indices
+    + 1, written into `labels` if given (int32).
+    '''
+
+    def __init__(self, mask, labels=None):
+        if labels is None:
+            n_blobs, labels, stats, centroids = cv2.connectedComponentsWithStats(mask)
+        else:
+            n_blobs, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, labels=labels)
+        self.labels = labels
+        self.areas = stats[1:, cv2.CC_STAT_AREA]
+        self.boxes = stats[1:, :4]
+        self.centroids = centroids[1:]
+        self.radii = np.sqrt(self.areas / np.pi)
+
+    def __len__(self):
+        return len(self.areas)
+
+    def largest(self, min_radius=0, selection=None):
+        '''Index of the largest blob with a radius above `min_radius` (among `selection`), or None.'''
+        candidates = self.radii > min_radius
+        if selection is not None:
+            candidates &= selection
+        if not candidates.any():
+            return None
+        return int(np.argmax(np.where(candidates, self.areas, -1)))
+
+
+class BallDetector(object):
+    '''Detects a colored ball with a configurable chain of stages.
+
+    `stages` is a subset of STAGES in the order they are applied:
+        blur      - Gaussian blur of the BGR image (11 x 11)
+        hsv       - conversion from BGR to HSV
+        threshold - mask of the pixels within the color bounds
+        lut       - instead of hsv and threshold, the mask from a ColorLUT
+        erode     - `iterations` erosions of the mask (3 x 3)
+        dilate    - `iterations` dilations of the mask
+        contours  - center and enclosing circle of the largest contour
+        components - instead of contours, the largest blob of one connected
+                    components pass, with its centroid and equivalent radius
+    Every stage writes into its own buffer, which is allocated on the first
+    frame and only grows if a larger image comes along, so also smaller
+    regions of the image (see `RoiBallDetector`) reuse it. The time spent in
+    each stage is accumulated in `timer`.
+
+    If an HSV image is passed to `detect` (e.g. converted from YUV422), the
+    stages before `threshold` are skipped. The `timestamp` passed to `detect`
+    (e.g. the time the image was taken) is kept in `timestamp`, it tells
+    which image the center belongs to, also with the wrappers below that
+    reuse or delay a result.
+    '''
+
+    def __init__(self, stages=DEFAULT_STAGES, min_radius=10, draw=True, timer=None, prefix='', iterations=2,
+                 lut_cache_dir=LUT_CACHE_DIR):
+        for name in stages:
+            if name not in STAGES:
+                raise ValueError('unknown stage {}, the stages are {}'.format(name, ', '.join(STAGES)))
+        stages = list(stages)
+        if 'lut' in stages:
+            if 'hsv' in stages or 'threshold' in stages:
+                raise ValueError('the stage lut replaces hsv and threshold')
+            mask_stages = ['lut']
+        else:
+            mask_stages = ['hsv', 'threshold']
+        if 'contours' in stages and 'components' in stages:
+            raise ValueError('only one of the stages contours and components can be used')
+        blob_stage = 'components' if 'components' in stages else 'contours'
+        for name in mask_stages + [blob_stage]:
+            if name not in stages:
+                raise ValueError('the stage {} is required'.format(name))
+        order = [stages.index(name) for name in mask_stages + [blob_stage]]
+        if order != sorted(order) or stages[-1] != blob_stage:
+            raise ValueError('the stages {} have to be in this order, the last one at the end'.format(
+                ', '.join(mask_stages + [blob_stage])))
+        if 'blur' in stages and stages.index('blur') > stages.index(mask_stages[0]):
+            raise ValueError('the blur is applied to the BGR image, i.e. before {}'.format(mask_stages[0]))
+
+        self.stages = list(stages)
+        self.min_radius = min_radius
+        self.draw = draw
+        self.iterations = iterations
+
+        self.buffers = {}
+        self.timer = StageTimer() if timer is None else timer
+        self.prefix = prefix
+        self.luts = {}
+        self.lut_cache_dir = lut_cache_dir
+
+        # the timer label and bound method of each stage, built once instead of on every frame,
+        # the second chain starts at the threshold for an HSV image passed to `detect`
+        if 'lut' in stages:
+            hsv_stages = ['threshold'] + stages[stages.index('lut') + 1:]
+        else:
+            hsv_stages = stages[stages.index('threshold'):]
+        self.chain = [(prefix + name, getattr(self, '_' + name)) for name in stages]
+        self.hsv_chain = [(prefix + name, getattr(self, '_' + name)) for name in hsv_stages]
+
+        self.bounds = None
+        self.mask = None
+        self.center = None
+        self.circle = None
+        self.timestamp = None
+
+    def buffer(self, name, shape):
+        '''Preallocated output of a stage, reallocated only if it is too small.'''
+        return Buffer(self.buffers, name, shape)
+
+    def detect(self, frame, colorLower, colorUpper, hsv=None, timestamp=None):
+        '''Returns the frame (with the ball drawn on it) and the center of the ball or None.'''
+        self.timestamp = timestamp
+        image = frame
+        chain = self.chain
+        if hsv is not None:
+            # the lookup table needs BGR, so the HSV image is thresholded
+            image = hsv
+            chain = self.hsv_chain
+
+        self.bounds = (colorLower, colorUpper)
+        for label, stage in chain:
+            start = timer()
+            image = stage(image)
+            self.timer.add(label, timer() - start)
+
+        center, circle = image
+        self.center = center
+        self.circle = circle
+
+        if center is not None and self.draw:
+            start = timer()
+            # draw the circle and centroid on the frame,
+            # then update the list of tracked points
+            DrawBall(frame, center, circle)
+            self.timer.add(self.prefix + 'draw', timer() - start)
+
+        return frame, center
+
+    def _blur(self, image):
+        # Smoothing Images
+        # http://docs.opencv.org/master/d4/d13/tutorial_py_filtering.html#gsc.tab=0
+        return cv2.GaussianBlur(image, (11, 11), 0, dst=self.buffer('blur', image.shape))
+
+    def _hsv(self, image):
+        # Converts an image from one color space to another
+        # http://docs.opencv.org/master/df/d9d/tutorial_py_colorspaces.html#gsc.tab=0
+        return cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=self.buffer('hsv', image.shape))
+
+    def _threshold(self, image):
+        # construct a mask for the color
+        self.mask = cv2.inRange(image, self.bounds[0], self.bounds[1],
+                                dst=self.buffer('threshold', image.shape[:2]))
+        return self.mask
+
+    def _lut(self, image):
+        # the same mask with a lookup table compiled from the color bounds
+        bounds = (tuple(self.bounds[0]), tuple(self.bounds[1]))
+        if bounds not in self.luts:
+            self.luts[bounds] = ColorLUT({'ball': bounds}, cache_dir=self.lut_cache_dir)
+        self.mask = self.luts[bounds].classify(image, 'ball', out=self.buffer('lut', image.shape[:2]))
+        return self.mask
+
+    def _erode(self, image):
+        # then perform a series of dilations and erosions
+        # to remove any small blobs left in the mask
+        self.mask = cv2.erode(image, None, dst=self.buffer('erode', image.shape), iterations=self.iterations)
+        return self.mask
+
+    def _dilate(self, image):
+        self.mask = cv2.dilate(image, None, dst=self.buffer('dilate', image.shape), iterations=self.iterations)
+        return self.mask
+
+    def _contours(self, image, offset=(0, 0)):
+        # find contours in the mask and initialize the current
+        # (x, y) center of the ball (the mask is not modified since OpenCV 3.2),
+        # `offset` is the position of the image in the frame
+        cnts = cv2.findContours(image, cv2.RETR_EXTERNAL,
+                                cv2.CHAIN_APPROX_SIMPLE, offset=offset)[-2]
+
+        # only proceed if at least one contour was found
+        if len(cnts) == 0:
+            return None, None
+
+        # find the largest contour in the mask, then use
+        # it to compute the minimum enclosing circle and
+        # centroid
+        c = max(cnts, key=cv2.contourArea)
+        ((x, y), radius) = cv2.minEnclosingCircle(c)
+        M = cv2.moments(c)
+
+        # only proceed if the radius meets a minimum size
+        if radius <= self.min_radius or M["m00"] == 0:
+            return None, None
+
+        center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
+        return center, ((x, y), radius)
+
+    def _components(self, image, offset=(0, 0)):
+        # all blobs with their area, centroid and radius in one pass,
+        # the largest one above the minimum radius is the ball
+        blobs = Blobs(image, labels=Buffer(self.buffers, 'components', image.shape, np.int32))
+        blob = blobs.largest(self.min_radius)
+        if blob is None:
+            return None, None
+
+        x, y = blobs.centroids[blob] + offset
+        return (int(x), int(y)), ((x, y), blobs.radii[blob])
+
+
+class RoiBallDetector(object):
+    '''Searches the ball only in a window around its last position.
+
+    The window is centered on the last center moved by the last velocity and
+    its half size is `radius_factor` times the last radius plus the distance
+    the ball moved since the previous frame plus `margin` pixels. If the ball
+    is not found in the window, or there was no ball in the previous frame,
+    the whole frame is searched. `roi_hits` and `full_searches` count how
+    often each happened. It has the same interface as `BallDetector`.
+    '''
+
+    def __init__(self, detector, radius_factor=2.5, margin=16):
+        self.detector = detector
+        self.radius_factor = radius_factor
+        self.margin = margin
+
+        # the circle is drawn here, in the coordinates of the whole frame
+        self.draw = detector.draw
+        detector.draw = False
+
+        self.center = None
+        self.circle = None
+        self.timestamp = None
+        self.velocity = (0, 0)
+        self.window = None
+
+        self.roi_hits = 0
+        self.full_searches = 0
+
+    @property
+    def timer(self):
+        return self.detector.timer
+
+    @property
+    def mask(self):
+        return self.detector.mask
+
+    def search_window(self, shape):
+        '''The window (x0, y0, x1, y1) to search in, None for the whole frame.'''
+        if self.center is None:
+            return None
+
+        height, width = shape[:2]
+        speed = max(abs(self.velocity[0]), abs(self.velocity[1]))
+        half = int(self.radius_factor * self.circle[1] + speed + self.margin)
+        x = self.center[0] + self.velocity[0]
+        y = self.center[1] + self.velocity[1]
+
+        x0, y0 = max(0, x - half), max(0, y - half)
+        x1, y1 = min(width, x + half), min(height, y + half)
+        if x1 - x0 < 4 or y1 - y0 < 4:
+            return None
+        return x0, y0, x1, y1
+
+    def detect(self, frame, colorLower, colorUpper, hsv=None, timestamp=None):
+        self.timestamp = timestamp
+        self.window = self.search_window(frame.shape)
+        center = None
+
+        if self.window is not None:
+            x0, y0, x1, y1 = self.window
+            crop_hsv = None if hsv is None else hsv[y0:y1, x0:x1]
+            _, center = self.detector.detect(frame[y0:y1, x0:x1], colorLower, colorUpper, crop_hsv)
+            if center is not None:
+                self.roi_hits += 1
+                (x, y), radius = self.detector.circle
+                center = (center[0] + x0, center[1] + y0)
+                circle = ((x + x0, y + y0), radius)
+
+        if center is None:
+            # lost (or never found), search the whole frame
+            self.window = None
+            self.full_searches += 1
+            _, center = self.detector.detect(frame, colorLower, colorUpper, hsv)
+            circle = self.detector.circle
+
+        if center is None:
+            self.velocity = (0, 0)
+            self.circle = None
+        else:
+            if self.center is not None:
+                self.velocity = (center[0] - self.center[0], center[1] - self.center[1])
+            self.circle = circle
+
+            if self.draw:
+                DrawBall(frame, center, circle)
+
+        self.center = center
+        return frame, center
+
+
+class PyramidBallDetector(object):
+    '''Finds the ball on a downsampled image and refines it at full resolution.
+
+    The frame is shrunk by `factor` (2 or 4) and the stages run on the small
+    image, where most of the frame is empty anyway. Then the same stages run
+    at full resolution only in the box around the candidate, so the center
+    and the radius are the same as those of `BallDetector`. If the ball is
+    not found in the box, the candidate is scaled up instead (if it is above
+    `min_radius`). On the small image the erosions and dilations are scaled
+    down with the factor (one each for 2, none for 4) and the candidate may
+    be one pixel smaller, so a ball just above `min_radius` is still found.
+    It has the same interface as `BallDetector` (and can be wrapped in a
+    `RoiBallDetector`).
+    '''
+
+    def __init__(self, stages=DEFAULT_STAGES, factor=2, min_radius=10, draw=True, margin=4):
+        self.factor = factor
+        self.margin = margin
+        self.draw = draw
+
+        self.timer = StageTimer()
+        # the two erosions remove 2 pixels at full resolution, i.e. 2 / factor pixels of the small image,
+        # and the border pixels mixed with the background by the downsampling may fall out of the color range,
+        # so the coarse pass also accepts a ball one pixel smaller, the fine pass checks the radius
+        self.coarse = BallDetector(stages, max(0.0, float(min_radius) / factor - 1.0), draw=False, timer=self.timer,
+                                   prefix='coarse ', iterations=2 // factor)
+        self.fine = BallDetector(stages, min_radius, draw=False, timer=self.timer, prefix='fine ')
+        self.buffers = {}
+
+        self.center = None
+        self.circle = None
+        self.timestamp = None
+        self.window = None
+
+    @property
+    def mask(self):
+        return self.coarse.mask
+
+    def detect(self, frame, colorLower, colorUpper, hsv=None, timestamp=None):
+        self.timestamp = timestamp
+        factor = self.factor
+        height, width = frame.shape[:2]
+        size = (width // factor, height // factor)
+
+        start = timer()
+        small = cv2.resize(frame, size, dst=Buffer(self.buffers, 'frame', (size[1], size[0]) + frame.shape[2:]),
+                           interpolation=cv2.INTER_AREA)
+        small_hsv = None
+        if hsv is not None:
+            # averaging the hue would be wrong around red, hence nearest
+            small_hsv = cv2.resize(hsv, size, dst=Buffer(self.buffers, 'hsv', (size[1], size[0], 3)),
+                                   interpolation=cv2.INTER_NEAREST)
+        self.timer.add('downsample', timer() - start)
+
+        _, center = self.coarse.detect(small, colorLower, colorUpper, small_hsv)
+        self.window = None
+        circle = None
+
+        if center is not None:
+            # box around the candidate at full resolution
+            (x, y), radius = self.coarse.circle
+            x, y, half = x * factor, y * factor, int(1.5 * radius * factor + self.margin * factor)
+            x0, y0 = max(0, int(x) - half), max(0, int(y) - half)
+            x1, y1 = min(width, int(x) + half), min(height, int(y) + half)
+            self.window = (x0, y0, x1, y1)
+
+            crop_hsv = None if hsv is None else hsv[y0:y1, x0:x1]
+            _, fine_center = self.fine.detect(frame[y0:y1, x0:x1], colorLower, colorUpper, crop_hsv)
+            if fine_center is not None:
+                (fx, fy), radius = self.fine.circle
+                center = (fine_center[0] + x0, fine_center[1] + y0)
+                circle = ((fx + x0, fy + y0), radius)
+            elif radius * factor > self.fine.min_radius:
+                center = (int(x), int(y))
+                circle = ((x, y), radius * factor)
+            else:
+                center = None
+
+        self.center = center
+        self.circle = circle
+
+        if center is not None and self.draw:
+            DrawBall(frame, center, circle)
+
+        return frame, center
+
+
+class ChangeGateBallDetector(object):
+    '''Skips the detection while the scene does not change.
+
+    Each frame is shrunk to a grayscale thumbnail of `size` (width, height)
+    pixels, which costs a small fraction of the detection and averages out
+    the sensor noise. If no pixel of the thumbnail differs from the one of
+    the last processed frame by `threshold` gray levels or more (the largest
+    difference is kept in `difference`), the previous result is reused,
+    but at least every `refresh` frames the detection runs anyway. `hits`
+    counts the reused results and `misses` the frames that were processed.
+    A reused result keeps the `timestamp` of the frame it was detected in.
+    It has the same interface as `BallDetector` and wraps any of the
+    detectors above.
+    '''
+
+    def __init__(self, detector, threshold=6, refresh=15, size=(64, 48)):
+        self.detector = detector
+        self.threshold = threshold
+        self.refresh = refresh
+        self.size = size
+
+        # the circle is drawn here, also on frames that reuse it
+        self.draw = detector.draw
+        detector.draw = False
+
+        self.buffers = {}
+        self.thumbnail = None
+        self.reference = None
+        self.bounds = None
+        self.since_refresh = 0
+        self.difference = None
+
+        self.center = None
+        self.circle = None
+        self.timestamp = None
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def timer(self):
+        return self.detector.timer
+
+    @property
+    def mask(self):
+        return self.detector.mask
+
+    def changed(self, frame):
+        '''Returns whether the frame differs from the last processed one, keeps its thumbnail.'''
+        width, height = self.size
+        small = cv2.resize(frame, self.size, dst=Buffer(self.buffers, 'small', (height, width, 3)),
+                           interpolation=cv2.INTER_AREA)
+        thumbnail = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=Buffer(self.buffers, 'thumbnail', (height, width)))
+        self.thumbnail = thumbnail
+        if self.reference is None:
+            self.reference = np.empty_like(thumbnail)
+            self.difference = None
+            return True
+
+        diff = cv2.absdiff(thumbnail, self.reference, dst=Buffer(self.buffers, 'diff', (height, width)))
+        self.difference = cv2.minMaxLoc(diff)[1]
+        return self.difference >= self.threshold
+
+    def detect(self, frame, colorLower, colorUpper, hsv=None, timestamp=None):
+        start = timer()
+        changed = self.changed(frame)
+        self.timer.add('gate', timer() - start)
+
+        if (changed or self.since_refresh >= self.refresh or
+                self.bounds != (colorLower, colorUpper)):
+            self.misses += 1
+            self.since_refresh = 0
+            self.bounds = (colorLower, colorUpper)
+            np.copyto(self.reference, self.thumbnail)
+            _, self.center = self.detector.detect(frame, colorLower, colorUpper, hsv, timestamp)
+            self.circle = self.detector.circle
+            self.timestamp = self.detector.timestamp
+        else:
+            self.hits += 1
+            self.since_refresh += 1
+
+        if self.center is not None and self.draw:
+            DrawBall(frame, self.center, self.circle)
+
+        return frame, self.center
+
+
+class MultiBallDetector(object):
+    '''Detects a ball of every color in `color_bounds` in one pass.
+
+    All colors share the work on the whole image. The image is converted to
+    HSV once and classified into a label image in which bit k of each pixel
+    is set if it lies within the range of the k-th color of `names` (the
+    same as ColorLUT, whose table gives the label image in one lookup if
+    `stages` contain lut). As `cv2.inRange` tests each channel on its own,
+    the labels are the AND of three per-channel tables, one `cv2.LUT` per
+    channel whatever the number of colors. The erosions and dilations of
+    `stages` then run on all bits at once: eroding a bit is the AND over the
+    3 x 3 neighborhood and dilating it the OR, done with shifted
+    `cv2.bitwise_and` and `cv2.bitwise_or` over rows and columns. A pixel
+    within overlapping ranges counts for each of those colors, and balls of
+    different colors that touch stay apart.
+
+    Only the last stage (contours or components) runs for each color, on the
+    bounding box of its pixels and only if there are any. The results are
+    those of a BallDetector with the same `stages` for each color.
+    '''
+
+    def __init__(self, color_bounds, stages=DEFAULT_STAGES, min_radius=10, draw=True, lut_cache_dir=LUT_CACHE_DIR):
+        if len(color_bounds) > 8:
+            raise ValueError('at most 8 colors fit into the label image, got {}'.format(len(color_bounds)))
+
+        self.names = sorted(color_bounds)
+        self.bounds = [(tuple(color_bounds[name][0]), tuple(color_bounds[name][1])) for name in self.names]
+        self.draw = draw
+
+        # checks the stages, its blur and blob stage are used for all colors
+        self.detector = BallDetector(stages, min_radius, draw=False)
+        self.blur = 'blur' in stages
+        # the bits of the table are the colors in the same (sorted) order
+        self.lut = ColorLUT(color_bounds, cache_dir=lut_cache_dir) if 'lut' in stages else None
+
+        # bit k of tables[c][value] is set if value is within the k-th range of channel c
+        self.tables = np.zeros((3, 256), dtype=np.uint8)
+        for k, (lower, upper) in enumerate(self.bounds):
+            for channel in range(3):
+                self.tables[channel, max(int(lower[channel]), 0):max(int(upper[channel]) + 1, 0)] |= 1 << k
+
+        mask_stage = 'threshold' if self.lut is None else 'lut'
+        self.morphology = [(name, cv2.bitwise_and if name == 'erode' else cv2.bitwise_or)
+                           for name in stages[list(stages).index(mask_stage) + 1:-1]]
+        self.blob_stage = stages[-1]
+        self.find_blob = getattr(self.detector, '_' + self.blob_stage)
+
+        self.buffers = {}
+        self.timer = StageTimer()
+
+        self.labels = None
+        self.mask = None
+        self.centers = {}
+        self.circles = {}
+
+    def detect(self, frame, hsv=None):
+        '''Returns the frame (with the balls drawn on it) and the center of each color's ball or None.'''
+        height, width = frame.shape[:2]
+        labels = Buffer(self.buffers, 'labels', (height, width))
+
+        start = timer()
+        image = frame
+        if self.blur and hsv is None:
+            image = self.detector._blur(frame)
+        if self.lut is not None and hsv is None:
+            self.lut.labels(image, out=labels)
+        else:
+            if hsv is None:
+                hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=Buffer(self.buffers, 'hsv', frame.shape))
+            channel = Buffer(self.buffers, 'channel', (height, width))
+            for c in range(3):
+                cv2.extractChannel(hsv, c, dst=channel)
+                if c == 0:
+                    cv2.LUT(channel, self.tables[c], dst=labels)
+                else:
+                    cv2.LUT(channel, self.tables[c], dst=channel)
+                    cv2.bitwise_and(labels, channel, dst=labels)
+        self.timer.add('labels', timer() - start)
+
+        for name, combine in self.morphology:
+            start = timer()
+            labels = self._morph(labels, combine, name)
+            self.timer.add(name, timer() - start)
+        self.labels = labels
+
+        # the union of all colors, to show it
+        self.mask = cv2.threshold(labels, 0, 255, cv2.THRESH_BINARY,
+                                  dst=Buffer(self.buffers, 'mask', (height, width)))[1]
+
+        start = timer()
+        self.centers = dict((name, None) for name in self.names)
+        self.circles = dict((name, None) for name in self.names)
+        color = Buffer(self.buffers, 'color', (height, width))
+        for k, name in enumerate(self.names):
+            cv2.bitwise_and(labels, 1 << k, dst=color)
+            if cv2.countNonZero(color) == 0:
+                continue
+            x, y, w, h = cv2.boundingRect(color)
+            self.centers[name], self.circles[name] = self.find_blob(color[y:y + h, x:x + w], (x, y))
+        self.timer.add(self.blob_stage, timer() - start)
+
+        if self.draw:
+            for name in self.names:
+                if self.centers[name] is not None:
+                    DrawBall(frame, self.centers[name], self.circles[name], name)
+
+        return frame, self.centers
+
+    def _morph(self, labels, combine, name):
+        '''Erodes (bitwise_and) or dilates (bitwise_or) every bit like BallDetector.
+
+        `iterations` times the 3 x 3 square is the (2 * iterations + 1) square,
+        i.e. the rows and then the columns combined with their neighbors up to
+        `iterations` pixels away, pixels outside the image are left out.
+        '''
+        height, width = labels.shape
+        rows = Buffer(self.buffers, 'rows', (height, width))
+        out = Buffer(self.buffers, name, (height, width))
+
+        np.copyto(rows, labels)
+        for d in range(1, min(self.detector.iterations, width - 1) + 1):
+            combine(rows[:, d:], labels[:, :-d], dst=rows[:, d:])
+            combine(rows[:, :-d], labels[:, d:], dst=rows[:, :-d])
+        np.copyto(out, rows)
+        for d in range(1, min(self.detector.iterations, height - 1) + 1):
+            combine(out[d:], rows[:-d], dst=out[d:])
+            combine(out[:-d], rows[d:], dst=out[:-d])
+        return out
+
+
+def _ParallelWorker(stages, min_radius, colorLower, colorUpper, shape, frame_store, mask_store, jobs, results):
+    '''Runs a BallDetector in a worker process of ParallelBallDetector.'''
+    # the processes already use all cores, more threads per process only compete
+    cv2.setNumThreads(1)
+    frames = np.ctypeslib.as_array(frame_store).reshape((-1,) + shape)
+    masks = np.ctypeslib.as_array(mask_store).reshape((-1,) + shape[:2])
+    detector = BallDetector(stages, min_radius, draw=False)
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        seq, slot, is_hsv, submitted, max_latency = job
+        if max_latency is not None and time.time() - submitted > max_latency:
+            # stale by now, a newer frame is waiting
+            results.put((seq, slot, None, None, True, None))
+            continue
+
+        try:
+            if is_hsv:
+                detector.detect(frames[slot], colorLower, colorUpper, frames[slot])
+            else:
+                detector.detect(frames[slot], colorLower, colorUpper)
+            np.copyto(masks[slot], detector.mask)
+        except Exception:
+            # handed over to the main process, which raises it
+            results.put((seq, slot, None, None, False, traceback.format_exc()))
+            continue
+        results.put((seq, slot, detector.center, detector.circle, False, None))
+
+
+class ParallelBallDetector(object):
+    '''Runs the ball detection on a pool of worker processes.
+
+    `submit` copies a frame into one of `n_slots` frame slots in shared
+    memory and queues only its slot number, so no image is pickled. Each
+    worker runs its own BallDetector with `stages` and writes the mask into
+    a shared mask slot. `results` returns the results strictly in the order
+    the frames were submitted, while the workers may finish them in any
+    order. If all slots are taken, `submit` waits for a result.
+
+    With `max_latency` (in seconds) the pipeline stays latency-bounded: a
+    worker skips a frame that waited longer than that in the queue, and
+    `submit` drops the frame instead of waiting if no slot is free. The
+    results of skipped frames have `skipped` set and no center.
+
+    `detect` has the interface of BallDetector for the processing loop: it
+    submits the frame and returns the newest result that is in order, which
+    belongs to an earlier frame (about `n_workers` frames behind), whose
+    `timestamp` is kept with the result.
+
+    If the detection of a frame raises in a worker, `results` (and `detect`)
+    raise a RuntimeError with its traceback when that frame is due. Waiting
+    for a result raises a RuntimeError if a worker process died, so nothing
+    waits forever, and `close` stops the workers in any case.
+    '''
+
+    # seconds between the checks that the workers are alive while waiting
+    poll_interval = 0.5
+
+    def __init__(self, stages=DEFAULT_STAGES, n_workers=None, n_slots=None, max_latency=None, min_radius=10, draw=True):
+        # checks the stages before starting any process
+        BallDetector(stages, min_radius)
+        self.stages = list(stages)
+        self.n_workers = n_workers or max(1, multiprocessing.cpu_count() - 1)
+        self.n_slots = n_slots or 2 * self.n_workers
+        self.max_latency = max_latency
+        self.min_radius = min_radius
+        self.draw = draw
+
+        self.shape = None
+        self.bounds = None
+        self.workers = []
+        self.free = []
+        self.timer = StageTimer()
+
+        self.next_submit = 0
+        self.next_result = 0
+        self.finished = {}
+        self.timestamps = {}    # of the frames in flight
+        self.errors = {}        # traceback of the frames that failed
+
+        self.mask = None
+        self.center = None
+        self.circle = None
+        self.timestamp = None
+
+        self.submitted = 0
+        self.processed = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def _start(self, shape, colorLower, colorUpper):
+        self._stop()
+        self.shape = shape
+        self.bounds = (colorLower, colorUpper)
+        size = int(np.prod(shape))
+        self.frame_store = multiprocessing.RawArray('B', self.n_slots * size)
+        self.mask_store = multiprocessing.RawArray('B', self.n_slots * shape[0] * shape[1])
+        self.frames = np.ctypeslib.as_array(self.frame_store).reshape((self.n_slots,) + shape)
+        self.masks = np.ctypeslib.as_array(self.mask_store).reshape((self.n_slots,) + shape[:2])
+        self.jobs = multiprocessing.Queue()
+        self.done = multiprocessing.Queue()
+        self.free = list(range(self.n_slots))
+
+        for _ in range(self.n_workers):
+            worker = multiprocessing.Process(target=_ParallelWorker,
+                                             args=(self.stages, self.min_radius, colorLower, colorUpper, shape,
+                                                   self.frame_store, self.mask_store, self.jobs, self.done))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _collect(self, block):
+        '''Moves one result of the workers to `finished`, returns False if there was none.'''
+        while True:
+            try:
+                seq, slot, center, circle, skipped, error = self.done.get(block, self.poll_interval)
+                break
+            except queue.Empty:
+                if not block:
+                    return False
+            # the result of a worker that died never arrives
+            for worker in self.workers:
+                if not worker.is_alive():
+                    raise RuntimeError('a worker of the ball detection exited with code {}, {} frames are lost'.format(
+                        worker.exitcode, self.n_slots - len(self.free)))
+
+        mask = None
+        if error is not None:
+            self.errors[seq] = error
+            self.failed += 1
+        elif skipped:
+            self.skipped += 1
+        else:
+            mask = self.masks[slot].copy()
+            self.processed += 1
+        self.finished[seq] = (seq, self.timestamps.pop(seq), center, circle, mask, skipped)
+        self.free.append(slot)
+        return True
+
+    def submit(self, frame, colorLower, colorUpper, hsv=None, timestamp=None):
+        '''Queues the frame (or its HSV image), returns its sequence number or None if it was dropped.'''
+        image = frame if hsv is None else hsv
+        if image.shape != self.shape or self.bounds != (colorLower, colorUpper):
+            # (re)start the workers on the first frame or if the image format has changed,
+            # the results of the frames in flight are still delivered
+            while self.workers and len(self.free) < self.n_slots:
+                self._collect(True)
+            self._start(image.shape, colorLower, colorUpper)
+
+        start = timer()
+        while not self.free:
+            if self.max_latency is not None:
+                self.dropped += 1
+                self.timer.add('wait', timer() - start)
+                return None
+            self._collect(True)
+        self.timer.add('wait', timer() - start)
+
+        start = timer()
+        slot = self.free.pop()
+        np.copyto(self.frames[slot], image)
+        seq = self.next_submit
+        self.next_submit += 1
+        self.timestamps[seq] = timestamp
+        self.jobs.put((seq, slot, hsv is not None, time.time(), self.max_latency))
+        self.submitted += 1
+        self.timer.add('submit', timer() - start)
+        return seq
+
+    def results(self, block=False):
+        '''Returns the results that are ready in submission order, as (seq, timestamp, center, circle, mask, skipped).
+
+        With `block` it waits until all submitted frames are done.
+        '''
+        while self._collect(False):
+            pass
+        if block:
+            while len(self.free) < self.n_slots:
+                self._collect(True)
+
+        ready = []
+        while self.next_result in self.finished:
+            if self.next_result in self.errors:
+                if ready:
+                    # raised on the next call
+                    break
+                self.finished.pop(self.next_result)
+                error = self.errors.pop(self.next_result)
+                self.next_result += 1
+                raise RuntimeError('the ball detection failed in a worker process:\n{}'.format(error.rstrip()))
+            ready.append(self.finished.pop(self.next_result))
+            self.next_result += 1
+        return ready
+
+    def detect(self, frame, colorLower, colorUpper, hsv=None, timestamp=None):
+        '''Returns the frame (with the newest ball drawn on it) and the newest center of the ball or None.'''
+        self.submit(frame, colorLower, colorUpper, hsv, timestamp)
+        for seq, frame_timestamp, center, circle, mask, skipped in self.results():
+            if not skipped:
+                self.center, self.circle, self.mask = center, circle, mask
+                self.timestamp = frame_timestamp
+        if self.mask is None:
+            self.mask = np.zeros(frame.shape[:2], dtype=np.uint8)
+
+        if self.center is not None and self.draw:
+            DrawBall(frame, self.center, self.circle)
+
+        return frame, self.center
+
+    def stats(self):
+        return {'submitted': self.submitted,
+                'processed': self.processed,
+                'skipped': self.skipped,
+                'dropped': self.dropped,
+                'failed': self.failed}
+
+    def close(self):
+        '''Waits for the frames in flight (counted in `stats`, but not returned) and stops the worker processes.'''
+        try:
+            while self.workers and len(self.free) < self.n_slots:
+                self._collect(True)
+        except RuntimeError as e:
+            # e.g. a worker died, the others are stopped anyway
+            print(e)
+        finally:
+            self._stop()
+
+    def _stop(self, timeout=5.0):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.workers = []
+
+
+def RecordedFrames(prefix):
+    '''Yields the recorded frames of a session as BGR images.'''
+    for path in RecordingSegments(prefix):
+        header, records = OpenSegment(path)
+        for record in records:
+            frame = record['frame']
+            if header['color_space'] == kYUV422ColorSpace:
+                frame = YUV422ToBGR(frame)
+            yield frame
+
+
+# result of DetectBallBatch for each frame
+BATCH_DTYPE = np.dtype([('seconds', '<i4'),
+                        ('microseconds', '<i4'),
+                        ('found', '?'),
+                        ('x', '<f4'),
+                        ('y', '<f4'),
+                        ('radius', '<f4'),
+                        ('area', '<i4')])
+
+
+def DetectBallBatch(frames, colorLower, colorUpper, min_radius=10, chunk=64, color_space=13):
+    '''Detects the ball in a stack of frames, without drawing or showing anything.
+
+    `frames` is an (N, H, W, 3) uint8 array (or (N, H, W, 2) for YUV422 with
+    `color_space` 9), or the prefix of a recording whose segments are read
+    through their memory maps. The frames are processed `chunk` at a time:
+    each chunk is stacked into one tall image, so the HSV conversion and the
+    thresholding are a single call for the whole chunk, with empty rows
+    between the frames so that the erosions and dilations do not reach into
+    the neighbouring frame. One connected components pass finds the blobs of
+    all frames, the largest blob of each frame above `min_radius` (radius of
+    the circle with the same area) is its ball.
+
+    Returns a structured array of BATCH_DTYPE with one entry per frame, x, y
+    and radius are in pixels of the frame (the timestamps are only set for
+    recordings).
+    '''
+    if isinstance(frames, str):
+        results = []
+        for path in RecordingSegments(frames):
+            header, records = OpenSegment(path)
+            result = DetectBallBatch(records['frame'], colorLower, colorUpper, min_radius, chunk,
+                                     int(header['color_space']))
+            result['seconds'] = records['seconds']
+            result['microseconds'] = records['microseconds']
+            results.append(result)
+        return np.concatenate(results) if results else np.zeros(0, dtype=BATCH_DTYPE)
+
+    n_frames, height, width = frames.shape[:3]
+    pad = 4     # more than the 2 pixels reached by two dilations
+    results = np.zeros(n_frames, dtype=BATCH_DTYPE)
+    buffers = {}
+
+    for first in range(0, n_frames, chunk):
+        n = min(chunk, n_frames - first)
+
+        # one contiguous tall image of the chunk (this also reads it from the memory map)
+        stack = Buffer(buffers, 'stack', (n * height, width) + frames.shape[3:])
+        np.copyto(stack.reshape((n,) + frames.shape[1:]), frames[first:first + n])
+
+        if color_space == kYUV422ColorSpace:
+            hsv = YUV422ToHSV(stack, Buffer(buffers, 'hsv', (n * height, width, 3)),
+                              Buffer(buffers, 'bgr', (n * height, width, 3)))
+        else:
+            hsv = cv2.cvtColor(stack, cv2.COLOR_BGR2HSV, dst=Buffer(buffers, 'hsv', (n * height, width, 3)))
+        mask = cv2.inRange(hsv, colorLower, colorUpper, dst=Buffer(buffers, 'mask', (n * height, width)))
+
+        padded = Buffer(buffers, 'padded', (n, height + pad, width))
+        padded[:, height:] = 0
+        np.copyto(padded[:, :height], mask.reshape((n, height, width)))
+        padded = padded.reshape((n * (height + pad), width))
+        padded = cv2.erode(padded, None, dst=Buffer(buffers, 'erode', padded.shape), iterations=2)
+        padded = cv2.dilate(padded, None, dst=Buffer(buffers, 'dilate', padded.shape), iterations=2)
+
+        blobs = Blobs(padded, labels=Buffer(buffers, 'labels', padded.shape, np.int32))
+        keep = np.flatnonzero(blobs.radii > min_radius)
+        if keep.size == 0:
+            continue
+
+        # the largest blob of each frame: sort by frame, then area, and take the last of each frame
+        frame_of_blob = blobs.boxes[keep, cv2.CC_STAT_TOP] // (height + pad)
+        order = np.lexsort((blobs.areas[keep], frame_of_blob))
+        keep, frame_of_blob = keep[order], frame_of_blob[order]
+        last = np.append(frame_of_blob[1:] != frame_of_blob[:-1], True)
+        keep, frame_of_blob = keep[last], frame_of_blob[last]
+
+        result = results[first:first + n]
+        result['found'][frame_of_blob] = True
+        result['x'][frame_of_blob] = blobs.centroids[keep, 0]
+        result['y'][frame_of_blob] = blobs.centroids[keep, 1] - frame_of_blob * (height + pad)
+        result['radius'][frame_of_blob] = blobs.radii[keep]
+        result['area'][frame_of_blob] = blobs.areas[keep]
+
+    return results
+
+
+def CompareColorLUT(frames, colorLower, colorUpper, bits=5):
+    '''Times the HSV conversion with cv2.inRange against a ColorLUT and compares the masks.'''
+    lut = ColorLUT({'ball': [colorLower, colorUpper]}, bits)
+    hsv = mask_hsv = mask_lut = None
+    time_hsv = time_lut = 0.0
+    n_frames = n_pixels = n_equal = 0
+
+    for frame in frames:
+        start = timer()
+        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV, dst=hsv)
+        mask_hsv = cv2.inRange(hsv, colorLower, colorUpper, dst=mask_hsv)
+        time_hsv += timer() - start
+
+        start = timer()
+        mask_lut = lut.classify(frame, 'ball', out=mask_lut)
+        time_lut += timer() - start
+
+        n_frames += 1
+        n_pixels += mask_hsv.size
+        n_equal += np.count_nonzero(mask_hsv == mask_lut)
+
+    return {'frames': n_frames,
+            'hsv_ms': 1000.0 * time_hsv / max(n_frames, 1),
+            'lut_ms': 1000.0 * time_lut / max(n_frames, 1),
+            'agreement': float(n_equal) / max(n_pixels, 1)}
+
+
+def PeakAllocation(detector, frames, colorLower, colorUpper, warmup=5):
+    '''Largest memory (in bytes) allocated within one call of `detector.detect`.
+
+    The first `warmup` frames are not measured, they allocate the buffers.
+    NumPy (and OpenCV through it) reports its arrays to tracemalloc, so a
+    result far below the size of a frame means that no image is allocated
+    per frame. Needs Python 3.4 or later for tracemalloc.
+    '''
+    if tracemalloc is None:
+        raise RuntimeError('tracemalloc is not available in this Python version')
+
+    peak = 0
+    for k, frame in enumerate(frames):
+        if k < warmup:
+            detector.detect(frame, colorLower, colorUpper)
+            continue
+        tracemalloc.start()
+        detector.detect(frame, colorLower, colorUpper)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return peak
+
+
+if __name__ == "__main__":
+    '''Benchmarking the color classification on a recorded session'''
+
+    parser = argparse.ArgumentParser(description="Benchmark the ball detection on a recorded session")
+    parser.add_argument('prefix', type=str,
+                        help='Prefix of the recorded session, e.g. ./session for ./session_0000.frames, ...')
+    parser.add_argument('--lower', type=str, default='0,200,200',
+                        help='Lower HSV bound of the ball color.')
+    parser.add_argument('--upper', type=str, default='20,255,255',
+                        help='Upper HSV bound of the ball color.')
+    parser.add_argument('--bits', type=int, default=5,
+                        help='Bits per channel of the lookup table.')
+    parser.add_argument('--allocations', type=str, default=None,
+                        help='Instead of the benchmark, report the memory allocated per frame by the detection '
+                             'with these comma separated stages, e.g. hsv,threshold,erode,dilate,contours.')
+    parser.add_argument('--batch_out', type=str, default=None,
+                        help='Instead of the benchmark, detect the ball in every recorded frame and save the results '
+                             '(seconds, microseconds, found, x, y, radius, area) to this .npy file.')
+
+    args = parser.parse_args()
+
+    colorLower = tuple(int(x) for x in args.lower.split(','))
+    colorUpper = tuple(int(x) for x in args.upper.split(','))
+
+    if args.allocations is not None:
+        detector = BallDetector(args.allocations.split(','), draw=False)
+        frames = RecordedFrames(args.prefix)
+        peak = PeakAllocation(detector, frames, colorLower, colorUpper)
+        print("at most {} bytes allocated per frame".format(peak))
+    elif args.batch_out is not None:
+        start = timer()
+        results = DetectBallBatch(args.prefix, colorLower, colorUpper)
+        elapsed = timer() - start
+        np.save(args.batch_out, results)
+        print("found the ball in {} of {} frames in {:.1f} s, saved to {}".format(
+            np.count_nonzero(results['found']), len(results), elapsed, args.batch_out))
+    else:
+        stats = CompareColorLUT(RecordedFrames(args.prefix), colorLower, colorUpper, args.bits)
+        print("{frames} frames: HSV + inRange {hsv_ms:.3f} ms, lookup table {lut_ms:.3f} ms, "
+              "{agreement:.2%} of the pixels agree".format(**stats))
@@ -1,8 +1,8 @@
 import argparse
 import cv2
 import json
-import numpy as np
 from naoqi import ALProxy
+from nao_camera import ImageToArray
 
 def byteify(input):
     if isinstance(input, dict):
@@ -84,19 +84,8 @@ if __name__ == "__main__":
 
             '''The 6th index contains the array of the image.'''
             '''However, this array should be reshaped to the correct dimension (e.g. width and height)'''
-            # extract fields
-            width = naoImage[0]
-            height = naoImage[1]
-            nchannels = naoImage[2]
-            imgbuffer = naoImage[6]
-
-            # build opencv image (allocate on first pass)
-            if frame is None:
-                print('Obtained image of size {} x {}, with {} channels'.format(width, height, nchannels))
-                frame = np.asarray(bytearray(imgbuffer), dtype=np.uint8)
-                frame = frame.reshape((height, width, nchannels))
-            else:
-                frame.data = bytearray(imgbuffer)
+            # copy it into the reusable frame (allocated on first pass or when the size changes)
+            frame = ImageToArray(naoImage, frame)
 
             # show the frame to our screen
             cv2.imshow("Frame", frame)
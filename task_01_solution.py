@@ -1,8 +1,10 @@
 import argparse
 import cv2
 import json
-import numpy as np
+import os
 from naoqi import ALProxy
+from nao_camera import ImageToArray
+from nao_recorder import FrameRecorder, ImageWriter, FrameHistory, SessionPrefix
 
 def byteify(input):
     if isinstance(input, dict):
@@ -34,6 +36,18 @@ if __name__ == "__main__":
                         help='color space, for instance kBGRColorSpace is 13 and kYuvColorSpace is 0.')
     parser.add_argument('--fps', type=int, default=30,
                         help='frame rate could be between 1 and 30.')
+    parser.add_argument('--record_prefix', type=str, default=None,
+                        help='The images are recorded to <record_prefix>_0000.frames, ... '
+                             'Use `python nao_recorder.py <record_prefix>` to export them as JPEG images. '
+                             'By default every run gets its own prefix, ./session_<date>_<time>.')
+    parser.add_argument('--record_overwrite', action='store_true',
+                        help='Delete an earlier recording with the same --record_prefix, by default the script refuses to start.')
+    parser.add_argument('--record_continuous', action='store_true',
+                        help='Record every image, not only the ones after touching the middle tactile.')
+    parser.add_argument('--snapshot_dir', type=str, default=None,
+                        help='If given, touching the middle tactile also saves the current image as JPEG in this directory.')
+    parser.add_argument('--burst', type=int, default=0,
+                        help='Save this many images before and after the touch as well (needs --snapshot_dir).')
 
     args = parser.parse_args()
 
@@ -43,6 +57,12 @@ if __name__ == "__main__":
     with open("./config.json", 'r') as stream:
         config = byteify(json.load(stream))
 
+    # appends the images to memory-mapped files, the JPEG images are exported afterwards,
+    # created first as it refuses to overwrite an earlier recording
+    record_prefix = args.record_prefix if args.record_prefix is not None else SessionPrefix()
+    recorder = FrameRecorder(record_prefix, args.record_continuous, color_space=args.color_space,
+                             overwrite=args.record_overwrite)
+
     tts = ALProxy("ALTextToSpeech", config['robot_names'][NAO_name], PORT)
     memProxy = ALProxy("ALMemory", config['robot_names'][NAO_name], PORT)
 
@@ -61,9 +81,20 @@ if __name__ == "__main__":
                                       args.fps)
     print("subscribed name handle: {}".format(nameID))
     p_handle = tts.post.say("Starting the camera")
+
+    # writes JPEG snapshots in the background
+    writer = None
+    history = None
+    if args.snapshot_dir is not None:
+        if not os.path.isdir(args.snapshot_dir):
+            os.makedirs(args.snapshot_dir)
+        writer = ImageWriter(color_space=args.color_space)
+        if args.burst > 0:
+            history = FrameHistory(writer, args.snapshot_dir, args.burst, args.burst)
     counter = 0
     try:
         frame = None
+        lastMiddleTactile = 0.0
         # keep looping
         while True:
             key = cv2.waitKey(33) & 0xFF
@@ -71,13 +102,22 @@ if __name__ == "__main__":
                 break
 
             MiddleTactileON = memProxy.getData('Device/SubDeviceList/Head/Touch/Middle/Sensor/Value')
+            if MiddleTactileON != lastMiddleTactile:
+                # log the touch, so a replay of the session sees it as well
+                recorder.event('MiddleTactilTouched', MiddleTactileON)
+                lastMiddleTactile = MiddleTactileON
 
             if (MiddleTactileON):
 
                 if not(tts.isRunning(p_handle)):
                     p_handle = tts.post.say("Middle tactile touched.")
-                    if not(frame is None):
-                        cv2.imwrite('./saved_image_{:02d}.jpg'.format(counter), frame)
+                    # record the next image
+                    recorder.trigger()
+                    if history is not None:
+                        # frames before and after this moment
+                        history.trigger()
+                    elif writer is not None and not(frame is None):
+                        writer.submit(frame, os.path.join(args.snapshot_dir, 'saved_image_{:04d}.jpg'.format(counter)))
                         counter += 1
 
             # obtain image
@@ -85,24 +125,20 @@ if __name__ == "__main__":
 
             '''The 6th index contains the array of the image.'''
             '''However, this array should be reshaped to the correct dimension (e.g. width and height)'''
-            # extract fields
-            width = naoImage[0]
-            height = naoImage[1]
-            nchannels = naoImage[2]
-            imgbuffer = naoImage[6]
-
-            # build opencv image (allocate on first pass)
-            if frame is None:
-                print('Obtained image of size {} x {}, with {} channels'.format(width, height, nchannels))
-                frame = np.asarray(bytearray(imgbuffer), dtype=np.uint8)
-                frame = frame.reshape((height, width, nchannels))
-            else:
-                frame.data = bytearray(imgbuffer)
+            # copy it into the reusable frame (allocated on first pass or when the size changes)
+            frame = ImageToArray(naoImage, frame)
+            recorder.offer(frame, naoImage[4], naoImage[5])
+            if history is not None:
+                history.push(frame, naoImage[4], naoImage[5])
 
             # show the frame to our screen
             cv2.imshow("Frame", frame)
 
     finally:  # if anything goes wrong we'll make sure to unsubscribe
+        recorder.close()
+        if writer is not None:
+            writer.close()
+            print("snapshot statistics: {}".format(writer.stats()))
         print("unsubscribing from {}".format(nameID))
         camProxy.unsubscribe(nameID)
 
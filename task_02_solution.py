@@ -3,11 +3,13 @@ import cv2
 import sys
 import time
 import json
-import numpy as np
+import os
 
 from naoqi import ALProxy
 from naoqi import ALBroker
 from naoqi import ALModule
+from nao_camera import ImageToArray
+from nao_recorder import FrameRecorder, ImageWriter, FrameHistory, SessionPrefix
 
 def byteify(input):
     if isinstance(input, dict):
@@ -51,6 +53,8 @@ class ReactToTouch(ALModule):
         is detected.
 
         """
+        # log the touch, so a replay of the session sees it as well
+        recorder.event(strVarName, value)
 
         if value > 0:
             if not(self.tts.isRunning(self.job_handle)):
@@ -59,14 +63,26 @@ class ReactToTouch(ALModule):
                 memory.unsubscribeToEvent("MiddleTactilTouched", "ReactToTouch")
 
                 self.job_handle = self.tts.post.say("Middle tactile touched.")
-                if not(frame is None):
-                    cv2.imwrite('./saved_image_{:02d}.jpg'.format(self.counter), frame)
+                # record the next image, the main loop does the writing
+                recorder.trigger()
+                # the JPEG snapshot is written in the background as well
+                if history is not None:
+                    # frames before and after this moment
+                    history.trigger()
+                elif writer is not None and not(frame is None):
+                    writer.submit(frame, os.path.join(snapshot_dir, 'saved_image_{:04d}.jpg'.format(self.counter)))
                     self.counter += 1
                 memory.subscribeToEvent("MiddleTactilTouched", "ReactToTouch", "onTouched")
 
 def main(ip, port, params_cam):
     """ Main entry point
     """
+    # appends the images to memory-mapped files, the JPEG images are exported afterwards,
+    # created first as it refuses to overwrite an earlier recording
+    global recorder
+    recorder = FrameRecorder(params_cam['record_prefix'], params_cam['record_continuous'],
+                             color_space=params_cam['color_space'], overwrite=params_cam['record_overwrite'])
+
     # We need this broker to be able to construct
     # NAOqi modules and subscribe to other modules
     # The broker must stay alive until the program exists
@@ -77,6 +93,18 @@ def main(ip, port, params_cam):
                         port)        # parent broker port
 
 
+    # writes JPEG snapshots without blocking the event callback
+    global writer, snapshot_dir, history
+    writer = None
+    history = None
+    snapshot_dir = params_cam['snapshot_dir']
+    if snapshot_dir is not None:
+        if not os.path.isdir(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        writer = ImageWriter(color_space=params_cam['color_space'])
+        if params_cam['burst'] > 0:
+            history = FrameHistory(writer, snapshot_dir, params_cam['burst'], params_cam['burst'])
+
     global ReactToTouch
     ReactToTouch = ReactToTouch("ReactToTouch")
     camProxy = ALProxy("ALVideoDevice")
@@ -107,24 +135,20 @@ def main(ip, port, params_cam):
 
             '''The 6th index contains the array of the image.'''
             '''However, this array should be reshaped to the correct dimension (e.g. width and height)'''
-            # extract fields
-            width = naoImage[0]
-            height = naoImage[1]
-            nchannels = naoImage[2]
-            imgbuffer = naoImage[6]
-
-            # build opencv image (allocate on first pass)
-            if frame is None:
-                print('Obtained image of size {} x {}, with {} channels'.format(width, height, nchannels))
-                frame = np.asarray(bytearray(imgbuffer), dtype=np.uint8)
-                frame = frame.reshape((height, width, nchannels))
-            else:
-                frame.data = bytearray(imgbuffer)
+            # copy it into the reusable frame (allocated on first pass or when the size changes)
+            frame = ImageToArray(naoImage, frame)
+            recorder.offer(frame, naoImage[4], naoImage[5])
+            if history is not None:
+                history.push(frame, naoImage[4], naoImage[5])
 
             # show the frame to our screen
             cv2.imshow("Frame", frame)
 
     except KeyboardInterrupt:
+        recorder.close()
+        if writer is not None:
+            writer.close()
+            print("snapshot statistics: {}".format(writer.stats()))
         print("unsubscribing from {}".format(nameID))
         camProxy.unsubscribe(nameID)
         print("Interrupted by user, shutting down")
@@ -149,6 +173,18 @@ if __name__ == "__main__":
                         help='color space, for instance kBGRColorSpace is 13 and kYuvColorSpace is 0.')
     parser.add_argument('--fps', type=int, default=30,
                         help='frame rate could be between 1 and 30.')
+    parser.add_argument('--record_prefix', type=str, default=None,
+                        help='The images are recorded to <record_prefix>_0000.frames, ... '
+                             'Use `python nao_recorder.py <record_prefix>` to export them as JPEG images. '
+                             'By default every run gets its own prefix, ./session_<date>_<time>.')
+    parser.add_argument('--record_overwrite', action='store_true',
+                        help='Delete an earlier recording with the same --record_prefix, by default the script refuses to start.')
+    parser.add_argument('--record_continuous', action='store_true',
+                        help='Record every image, not only the ones after touching the middle tactile.')
+    parser.add_argument('--snapshot_dir', type=str, default=None,
+                        help='If given, touching the middle tactile also saves the current image as JPEG in this directory.')
+    parser.add_argument('--burst', type=int, default=0,
+                        help='Save this many images before and after the touch as well (needs --snapshot_dir).')
 
     args = parser.parse_args()
 
@@ -171,5 +207,10 @@ if __name__ == "__main__":
     params['resolution'] = resolution
     params['color_space'] = color_space
     params['fps'] = fps
+    params['record_prefix'] = args.record_prefix if args.record_prefix is not None else SessionPrefix()
+    params['record_continuous'] = args.record_continuous
+    params['record_overwrite'] = args.record_overwrite
+    params['snapshot_dir'] = args.snapshot_dir
+    params['burst'] = args.burst
 
     main(config['robot_names'][NAO_name], PORT, params)
@@ -3,12 +3,13 @@ import cv2
 import sys
 import time
 import json
-import numpy as np
 import math
 
 from naoqi import ALProxy
 from naoqi import ALBroker
 from naoqi import ALModule
+from nao_camera import ImageToArray
+from nao_tracking import ClampHeadAngles
 
 def byteify(input):
     if isinstance(input, dict):
@@ -87,8 +88,10 @@ class MoveHeadTouch(ALModule):
             angles = [0.0, 0.0]
         elif command == 'Right':
             angles = [-45.0, 0.0]
+        # the range of the pitch depends on the yaw, the target is clamped before it is sent
+        target, limits = ClampHeadAngles([x * math.pi / 180.0 for x in angles])
         self.job_handle_motion = self.motionProxy.post.setAngles(self.joint_names,
-                                                                 [x * math.pi / 180.0 for x in angles],
+                                                                 target,
                                                                  self.params['fractionMaxSpeed'])
 
 
@@ -134,19 +137,8 @@ def main(ip, port, params_motion, params_cam):
 
             '''The 6th index contains the array of the image.'''
             '''However, this array should be reshaped to the correct dimension (e.g. width and height)'''
-            # extract fields
-            width = naoImage[0]
-            height = naoImage[1]
-            nchannels = naoImage[2]
-            imgbuffer = naoImage[6]
-
-            # build opencv image (allocate on first pass)
-            if frame is None:
-                print('Obtained image of size {} x {}, with {} channels'.format(width, height, nchannels))
-                frame = np.asarray(bytearray(imgbuffer), dtype=np.uint8)
-                frame = frame.reshape((height, width, nchannels))
-            else:
-                frame.data = bytearray(imgbuffer)
+            # copy it into the reusable frame (allocated on first pass or when the size changes)
+            frame = ImageToArray(naoImage, frame)
 
             # show the frame to our screen
             cv2.imshow("Frame", frame)
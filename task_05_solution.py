@@ -1,12 +1,15 @@
 import argparse
-import cv2
-import numpy as np
 from naoqi import ALProxy
 import time
 import os
 import json
+from nao_camera import ImageToArray, CaptureThread, DualCamera
+from nao_camera import kYUV422ColorSpace, YUV422ToBGR
+from nao_replay import ReplaySession, EndOfReplay
+from nao_display import DisplayThread
+from nao_vision import BallDetector, MultiBallDetector, ParallelBallDetector, ChangeGateBallDetector, STAGES, DEFAULT_STAGES
 
-global motionProxy, camProxy
+global motionProxy, camProxy, detector, display, timestamp
 
 def byteify(input):
     if isinstance(input, dict):
@@ -20,70 +23,30 @@ def byteify(input):
         return input
 
 def GetImage(frame, nameID):
+    global timestamp
     # obtain image
     naoImage = camProxy.getImageRemote(nameID)
+    # the 5th and 6th index contain the time the image was taken (seconds and microseconds),
+    # if it has not changed the camera has not taken a new image since the last call
+    if naoImage[4] + naoImage[5] * 1e-6 == timestamp:
+        return None
+    timestamp = naoImage[4] + naoImage[5] * 1e-6
 
     '''The 6th index contains the array of the image.'''
     '''However, this array should be reshaped to the correct dimension (e.g. width and height)'''
-    # extract fields
-    width = naoImage[0]
-    height = naoImage[1]
-    nchannels = naoImage[2]
-    imgbuffer = naoImage[6]
-
-    # build opencv image (allocate on first pass)
-    if frame is None:
-        print('Obtained image of size {} x {}, with {} channels'.format(width, height, nchannels))
-        frame = np.asarray(bytearray(imgbuffer), dtype=np.uint8)
-        frame = frame.reshape((height, width, nchannels))
-    else:
-        frame.data = bytearray(imgbuffer)
+    # copy it into the reusable frame (allocated on first pass or when the size changes)
+    frame = ImageToArray(naoImage, frame)
 
     return frame
 
 
 def DetectBall(frame, colorLower, colorUpper):
-    # Smoothing Images
-    # http://docs.opencv.org/master/d4/d13/tutorial_py_filtering.html#gsc.tab=0
-    blurred = cv2.GaussianBlur(frame, (11, 11), 0)
-    # Converts an image from one color space to another
-    # http://docs.opencv.org/master/df/d9d/tutorial_py_colorspaces.html#gsc.tab=0
-    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-
-    # construct a mask for the color, then perform
-    #  a series of dilations and erosions to remove any small
-    # blobs left in the mask
-    mask = cv2.inRange(hsv, colorLower, colorUpper)
-    mask = cv2.erode(mask, None, iterations=2)
-    mask = cv2.dilate(mask, None, iterations=2)
-
-    cv2.imshow("mask", mask)
-
-    # find contours in the mask and initialize the current
-    # (x, y) center of the ball
-    cnts = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL,
-                            cv2.CHAIN_APPROX_SIMPLE)[-2]
-    center = None
-
-    # only proceed if at least one contour was found
-    if len(cnts) > 0:
-        # find the largest contour in the mask, then use
-        # it to compute the minimum enclosing circle and
-        # centroid
-        c = max(cnts, key=cv2.contourArea)
-        ((x, y), radius) = cv2.minEnclosingCircle(c)
-        M = cv2.moments(c)
-        center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
-
-        # only proceed if the radius meets a minimum size
-        if radius > 10:
-        # draw the circle and centroid on the frame,
-        # then update the list of tracked points
-            cv2.circle(frame, (int(x), int(y)), int(radius),
-                       (0, 255, 255), 2)
-            cv2.circle(frame, center, 5, (0, 0, 255), -1)
-        else:
-            center = None
+    # The detection is a chain of stages (blur, hsv, threshold, erode, dilate, contours),
+    # see BallDetector in nao_vision.py, the stages are chosen with --stages
+    frame, center = detector.detect(frame, colorLower, colorUpper)
+
+    if display is not None:
+        display.show("mask", detector.mask)
 
     return frame, center
 
@@ -104,14 +67,44 @@ if __name__ == "__main__":
     parser.add_argument('--resolution', type=int, default=2,
                         help='0 -> 160x120, 1 -> 320x240, 2 -> 640x480, ...')
     parser.add_argument('--color_space', type=int, default=13,
-                        help='color space, for instance kBGRColorSpace is 13 and kYuvColorSpace is 0.')
+                        help='color space, for instance kBGRColorSpace is 13 and kYuvColorSpace is 0. '
+                             'kYUV422ColorSpace is 9, it needs only 2 bytes per pixel and is converted to BGR on this side.')
     parser.add_argument('--fps', type=int, default=30,
                         help='frame rate could be between 1 and 30.')
 
     parser.add_argument('--ball_color', type=str, default='red',
                         help='The color of the ball to be tracked, e.g. red, blue, etc.')
+    parser.add_argument('--dual_camera', action='store_true',
+                        help='Subscribe to the top and the bottom camera at once and detect the ball in both images.')
+    parser.add_argument('--all_colors', action='store_true',
+                        help='Detect a ball of every color in color_bounds at once, instead of only --ball_color.')
+    parser.add_argument('--stages', type=str, default=','.join(DEFAULT_STAGES),
+                        help='Comma separated stages of the ball detection, out of {}.'.format(','.join(STAGES)))
+    parser.add_argument('--timing', action='store_true',
+                        help='Print the time spent in each stage of the ball detection at the end.')
+    parser.add_argument('--gate_threshold', type=float, default=0,
+                        help='Reuse the last detection while no pixel of a 64 x 48 grayscale thumbnail changes by this '
+                             'many gray levels (e.g. 6), 0 to detect on every frame.')
+    parser.add_argument('--gate_refresh', type=int, default=15,
+                        help='With --gate_threshold, detect at least every this many frames.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Run the ball detection on this many worker processes, 0 to run it in the loop.')
+    parser.add_argument('--max_latency', type=float, default=None,
+                        help='With --workers, skip frames that waited longer than this (in seconds) for a worker.')
+    parser.add_argument('--headless', action='store_true',
+                        help='Do not show any images, stop with Ctrl+C.')
+    parser.add_argument('--display_fps', type=int, default=10,
+                        help='Rate at which the images are shown, on a separate thread (stop with q or Esc in a window).')
+    parser.add_argument('--capture_thread', action='store_true',
+                        help='Retrieve the images on a separate thread, so the detection does not wait for the network.')
+    parser.add_argument('--replay', type=str, default=None,
+                        help='Prefix of a recorded session (see nao_recorder.py), which is used instead of the robot.')
+    parser.add_argument('--replay_realtime', action='store_true',
+                        help='Replay the session at the recorded frame rate instead of as fast as possible.')
 
     args = parser.parse_args()
+    if args.replay is not None and args.dual_camera:
+        parser.error('--dual_camera cannot be used with --replay, a recording holds the images of one camera')
 
     NAO_name = args.NAO_name
     PORT = args.port
@@ -119,6 +112,12 @@ if __name__ == "__main__":
     with open("./config.json", 'r') as stream:
         config = byteify(json.load(stream))
 
+    replay = None
+    if args.replay is not None:
+        # the proxies serve the recorded session instead of connecting to the robot
+        replay = ReplaySession(args.replay, realtime=args.replay_realtime)
+        ALProxy = replay.ALProxy
+
     tts = ALProxy("ALTextToSpeech", config['robot_names'][NAO_name], PORT)
     motionProxy = ALProxy("ALMotion", config['robot_names'][NAO_name], PORT)
     memProxy = ALProxy("ALMemory", config['robot_names'][NAO_name], PORT)
@@ -131,11 +130,21 @@ if __name__ == "__main__":
     '''One could call the variable names by loading `vision_definitions` or simply use the index in the correct position:'''
     '''e.g. kQVGA or 1, kBGRColorSpace or 13, it only helps the readability of the code'''
     '''nameID is the handle that later is used to retrieve images or to unsubscribe'''
-    nameID = camProxy.subscribeCamera(args.sub_name,
-                                      args.camera_index,
-                                      args.resolution,
-                                      args.color_space,
-                                      args.fps)
+    '''With subscribeCameras both cameras are subscribed at once and getImagesRemote returns both images'''
+    dual = None
+    if args.dual_camera:
+        nameID = camProxy.subscribeCameras(args.sub_name,
+                                           [0, 1],
+                                           [args.resolution, args.resolution],
+                                           [args.color_space, args.color_space],
+                                           args.fps)
+        dual = DualCamera(camProxy, nameID, args.fps)
+    else:
+        nameID = camProxy.subscribeCamera(args.sub_name,
+                                          args.camera_index,
+                                          args.resolution,
+                                          args.color_space,
+                                          args.fps)
     print("subscribed name handle: {}".format(nameID))
 
     # http://colorizer.org/
@@ -147,21 +156,114 @@ if __name__ == "__main__":
                     'green': [(60, 100, 50), (100, 200, 150)],
                     'red': [(0, 200, 200), (20, 255, 255)]}
 
+    detector = BallDetector(args.stages.split(','))
+    parallel = None
+    if args.workers > 0:
+        # the detection runs on worker processes, see ParallelBallDetector in nao_vision.py
+        parallel = ParallelBallDetector(args.stages.split(','), args.workers, max_latency=args.max_latency)
+        detector = parallel
+    gate = None
+    if args.gate_threshold > 0:
+        # skip the detection while the scene is static, see ChangeGateBallDetector in nao_vision.py
+        gate = ChangeGateBallDetector(detector, args.gate_threshold, args.gate_refresh)
+        detector = gate
+    multi = None
+    if args.all_colors:
+        # one pass for all colors, see MultiBallDetector in nao_vision.py
+        multi = MultiBallDetector(color_bounds, args.stages.split(','))
+        detector = multi
+
+    capture = None
+    if args.capture_thread and dual is None:
+        capture = CaptureThread(camProxy, nameID)
+        capture.start()
+
+    # the images are shown on their own thread, the loop never waits for the GUI
+    display = None
+    if not args.headless:
+        display = DisplayThread(args.display_fps)
+        display.start()
+
     try:
         frame = None
+        image = None
+        timestamp = None
+        seen_by = None
         # keep looping
         while True:
-            key = cv2.waitKey(33) & 0xFF
-            if key == ord('q') or key == 27:
+            if display is not None and display.quit.is_set():
                 break
 
-            frame = GetImage(frame, nameID)
-            frame, center = DetectBall(frame, color_bounds[args.ball_color][0], color_bounds[args.ball_color][1])
+            if dual is not None:
+                # top image above the bottom image, None if both are the same as before
+                new_frame = dual.grab()
+                if new_frame is None:
+                    time.sleep(0.25 / args.fps)
+                    continue
+                frame = new_frame
+            elif capture is None:
+                new_frame = GetImage(frame, nameID)
+                if new_frame is None:
+                    # the same image again, it is not detected (and the head not moved) twice
+                    time.sleep(0.25 / args.fps)
+                    continue
+                frame = new_frame
+            else:
+                # newest frame of the capture thread (None until the first one arrived),
+                # waiting for a new one paces the loop now that it does not wait for keys
+                frame = capture.read(timeout=1.0)
+                if frame is None:
+                    continue
+            if args.color_space == kYUV422ColorSpace:
+                # one conversion with OpenCV, the detection goes on from BGR as with kBGRColorSpace
+                image = YUV422ToBGR(frame, image)
+            else:
+                image = frame
+            if multi is not None:
+                image = multi.detect(image)[0]
+                if display is not None:
+                    display.show("mask", multi.mask)
+            else:
+                image, center = DetectBall(image, color_bounds[args.ball_color][0], color_bounds[args.ball_color][1])
+                if dual is not None:
+                    # camera that sees the ball and the center in its own image
+                    camera_index = None
+                    if center is not None:
+                        camera_index, center = dual.split_center(center)
+                    if camera_index != seen_by:
+                        if camera_index is None:
+                            print("the ball left the images")
+                        else:
+                            print("the {} camera sees the ball at {}".format(('top', 'bottom')[camera_index], center))
+                        seen_by = camera_index
 
             # show the frame to our screen
-            cv2.imshow("frame", frame)
+            if display is not None:
+                display.show("frame", image)
+
+    except EndOfReplay:
+        print("end of the recorded session")
+
+    except KeyboardInterrupt:
+        print("interrupted")
 
     finally:  # if anything goes wrong we'll make sure to unsubscribe
+        if display is not None:
+            display.stop()
+        if args.timing:
+            print("time per stage of the ball detection:\n{}".format(detector.timer.report()))
+            if gate is not None:
+                print("reused the last detection: {}, detected: {}".format(gate.hits, gate.misses))
+        if parallel is not None:
+            parallel.close()
+            print("parallel detection statistics: {}".format(parallel.stats()))
+        if capture is not None:
+            capture.stop()
+            print("capture statistics: {}".format(capture.stats()))
+        if dual is not None:
+            print("dual camera statistics: {}".format(dual.stats()))
+        if replay is not None:
+            print("replay statistics: {}".format(replay.stats()))
         print("unsubscribing from {}".format(nameID))
         camProxy.unsubscribe(nameID)
 
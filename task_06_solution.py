@@ -1,12 +1,17 @@
 import argparse
 import cv2
-import numpy as np
 from naoqi import ALProxy
 import time
 import os
 import json
+from nao_camera import ImageToArray, CaptureThread
+from nao_camera import kYUV422ColorSpace, YUV422ToBGR
+from nao_replay import ReplaySession, EndOfReplay
+from nao_display import DisplayThread
+from nao_tracking import BallTracker, HeadController, Gaze, MotionCommander, ClampHeadAngles, HeadAngleHistory
+from nao_vision import BallDetector, RoiBallDetector, PyramidBallDetector, ParallelBallDetector, ChangeGateBallDetector, STAGES, DEFAULT_STAGES
 
-global motionProxy, camProxy
+global motionProxy, camProxy, detector, display, timestamp
 
 def byteify(input):
     if isinstance(input, dict):
@@ -20,70 +25,31 @@ def byteify(input):
         return input
 
 def GetImage(frame, nameID):
+    global timestamp
     # obtain image
     naoImage = camProxy.getImageRemote(nameID)
+    # the 5th and 6th index contain the time the image was taken (seconds and microseconds),
+    # if it has not changed the camera has not taken a new image since the last call
+    if naoImage[4] + naoImage[5] * 1e-6 == timestamp:
+        return None
+    timestamp = naoImage[4] + naoImage[5] * 1e-6
 
     '''The 6th index contains the array of the image.'''
     '''However, this array should be reshaped to the correct dimension (e.g. width and height)'''
-    # extract fields
-    width = naoImage[0]
-    height = naoImage[1]
-    nchannels = naoImage[2]
-    imgbuffer = naoImage[6]
-
-    # build opencv image (allocate on first pass)
-    if frame is None:
-        print('Obtained image of size {} x {}, with {} channels'.format(width, height, nchannels))
-        frame = np.asarray(bytearray(imgbuffer), dtype=np.uint8)
-        frame = frame.reshape((height, width, nchannels))
-    else:
-        frame.data = bytearray(imgbuffer)
+    # copy it into the reusable frame (allocated on first pass or when the size changes)
+    frame = ImageToArray(naoImage, frame)
 
     return frame
 
 
 def DetectBall(frame, colorLower, colorUpper):
-    # Smoothing Images
-    # http://docs.opencv.org/master/d4/d13/tutorial_py_filtering.html#gsc.tab=0
-    blurred = cv2.GaussianBlur(frame, (11, 11), 0)
-    # Converts an image from one color space to another
-    # http://docs.opencv.org/master/df/d9d/tutorial_py_colorspaces.html#gsc.tab=0
-    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-
-    # construct a mask for the color, then perform
-    #  a series of dilations and erosions to remove any small
-    # blobs left in the mask
-    mask = cv2.inRange(hsv, colorLower, colorUpper)
-    mask = cv2.erode(mask, None, iterations=2)
-    mask = cv2.dilate(mask, None, iterations=2)
-
-    cv2.imshow("mask", mask)
-
-    # find contours in the mask and initialize the current
-    # (x, y) center of the ball
-    cnts = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL,
-                            cv2.CHAIN_APPROX_SIMPLE)[-2]
-    center = None
-
-    # only proceed if at least one contour was found
-    if len(cnts) > 0:
-        # find the largest contour in the mask, then use
-        # it to compute the minimum enclosing circle and
-        # centroid
-        c = max(cnts, key=cv2.contourArea)
-        ((x, y), radius) = cv2.minEnclosingCircle(c)
-        M = cv2.moments(c)
-        center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
-
-        # only proceed if the radius meets a minimum size
-        if radius > 10:
-        # draw the circle and centroid on the frame,
-        # then update the list of tracked points
-            cv2.circle(frame, (int(x), int(y)), int(radius),
-                       (0, 255, 255), 2)
-            cv2.circle(frame, center, 5, (0, 0, 255), -1)
-        else:
-            center = None
+    # The detection is a chain of stages (blur, hsv, threshold, erode, dilate, contours),
+    # see BallDetector in nao_vision.py, the stages are chosen with --stages,
+    # the timestamp of the image the center belongs to is kept in detector.timestamp
+    frame, center = detector.detect(frame, colorLower, colorUpper, timestamp=timestamp)
+
+    if display is not None:
+        display.show("mask", detector.mask)
 
     return frame, center
 
@@ -104,12 +70,63 @@ if __name__ == "__main__":
     parser.add_argument('--resolution', type=int, default=2,
                         help='0 -> 160x120, 1 -> 320x240, 2 -> 640x480, ...')
     parser.add_argument('--color_space', type=int, default=13,
-                        help='color space, for instance kBGRColorSpace is 13 and kYuvColorSpace is 0.')
+                        help='color space, for instance kBGRColorSpace is 13 and kYuvColorSpace is 0. '
+                             'kYUV422ColorSpace is 9, it needs only 2 bytes per pixel and is converted to BGR on this side.')
     parser.add_argument('--fps', type=int, default=30,
                         help='frame rate could be between 1 and 30.')
 
     parser.add_argument('--ball_color', type=str, default='red',
                         help='The color of the ball to be tracked, e.g. red, blue, etc.')
+    parser.add_argument('--stages', type=str, default=','.join(DEFAULT_STAGES),
+                        help='Comma separated stages of the ball detection, out of {}.'.format(','.join(STAGES)))
+    parser.add_argument('--timing', action='store_true',
+                        help='Print the time spent in each stage of the ball detection at the end.')
+    parser.add_argument('--pyramid', type=int, default=0,
+                        help='Search the ball on an image downsampled by this factor (2 or 4) first, 0 to search at full resolution.')
+    parser.add_argument('--roi', action='store_true',
+                        help='Search the ball only around its last position, and in the whole image once it is lost.')
+    parser.add_argument('--track', action='store_true',
+                        help='Predict the ball with a Kalman filter and detect it only every few frames while the prediction is good.')
+    parser.add_argument('--max_interval', type=int, default=4,
+                        help='With --track, the largest number of frames between two detections.')
+    parser.add_argument('--coalesce', action='store_true',
+                        help='Merge the head commands and send at most one every 50 ms, skipping changes within --deadband.')
+    parser.add_argument('--deadband', type=float, default=0.01,
+                        help='With --coalesce, head targets closer than this (in radians) to the last one are not sent.')
+    parser.add_argument('--gaze', action='store_true',
+                        help='Send the head straight to the ball with one setAngles, computed from the field of view '
+                             'of the camera and the current head angles, instead of a small changeAngles per frame.')
+    parser.add_argument('--controller_rate', type=float, default=0,
+                        help='Move the head from a PID controller running at this rate (in Hz) on its own thread, '
+                             '0 to send one changeAngles per frame.')
+    parser.add_argument('--kp', type=float, default=6.0,
+                        help='With --controller_rate, the proportional gain (rad/s per image width of error).')
+    parser.add_argument('--ki', type=float, default=0.0,
+                        help='With --controller_rate, the integral gain.')
+    parser.add_argument('--kd', type=float, default=0.3,
+                        help='With --controller_rate, the derivative gain.')
+    parser.add_argument('--latency_compensation', action='store_true',
+                        help='With --controller_rate or --gaze, locate the ball relative to the head angles at the time '
+                             'the image was taken, from a history of the measured angles.')
+    parser.add_argument('--gate_threshold', type=float, default=0,
+                        help='Reuse the last detection while no pixel of a 64 x 48 grayscale thumbnail changes by this '
+                             'many gray levels (e.g. 6), 0 to detect on every frame.')
+    parser.add_argument('--gate_refresh', type=int, default=15,
+                        help='With --gate_threshold, detect at least every this many frames.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Run the ball detection on this many worker processes, 0 to run it in the loop.')
+    parser.add_argument('--max_latency', type=float, default=None,
+                        help='With --workers, skip frames that waited longer than this (in seconds) for a worker.')
+    parser.add_argument('--headless', action='store_true',
+                        help='Do not show any images, stop with Ctrl+C.')
+    parser.add_argument('--display_fps', type=int, default=10,
+                        help='Rate at which the images are shown, on a separate thread (stop with q or Esc in a window).')
+    parser.add_argument('--capture_thread', action='store_true',
+                        help='Retrieve the images on a separate thread, so the detection does not wait for the network.')
+    parser.add_argument('--replay', type=str, default=None,
+                        help='Prefix of a recorded session (see nao_recorder.py), which is used instead of the robot.')
+    parser.add_argument('--replay_realtime', action='store_true',
+                        help='Replay the session at the recorded frame rate instead of as fast as possible.')
 
     args = parser.parse_args()
 
@@ -119,6 +136,12 @@ if __name__ == "__main__":
     with open("./config.json", 'r') as stream:
         config = byteify(json.load(stream))
 
+    replay = None
+    if args.replay is not None:
+        # the proxies serve the recorded session instead of connecting to the robot
+        replay = ReplaySession(args.replay, realtime=args.replay_realtime)
+        ALProxy = replay.ALProxy
+
     tts = ALProxy("ALTextToSpeech", config['robot_names'][NAO_name], PORT)
     motionProxy = ALProxy("ALMotion", config['robot_names'][NAO_name], PORT)
     memProxy = ALProxy("ALMemory", config['robot_names'][NAO_name], PORT)
@@ -160,31 +183,180 @@ if __name__ == "__main__":
 
     time.sleep(2.0)
 
+    parallel = None
+    if args.workers > 0:
+        # the detection runs on worker processes, see ParallelBallDetector in nao_vision.py,
+        # the center belongs to a frame a few frames back
+        parallel = ParallelBallDetector(args.stages.split(','), args.workers, max_latency=args.max_latency)
+        detector = parallel
+    elif args.pyramid > 1:
+        detector = PyramidBallDetector(args.stages.split(','), args.pyramid)
+    else:
+        detector = BallDetector(args.stages.split(','))
+    roi = None
+    if args.roi and parallel is None:
+        roi = RoiBallDetector(detector)
+        detector = roi
+    gate = None
+    if args.gate_threshold > 0:
+        # skip the detection while the scene is static, see ChangeGateBallDetector in nao_vision.py
+        gate = ChangeGateBallDetector(detector, args.gate_threshold, args.gate_refresh)
+        detector = gate
+
+    tracker = None
+    if args.track:
+        # between the detection and the head, see BallTracker in nao_tracking.py
+        tracker = BallTracker(max_interval=args.max_interval)
+
+    motion = motionProxy
+    commander = None
+    if args.coalesce:
+        # stands in for motionProxy for the head, see MotionCommander in nao_tracking.py
+        commander = MotionCommander(motionProxy, args.deadband, joint_names=joint_names)
+        motion = commander
+
+    history = None
+    if args.latency_compensation:
+        # the measured head angles with the timestamps of the robot, see HeadAngleHistory in nao_tracking.py
+        history = HeadAngleHistory(memProxy)
+        history.start()
+
+    gaze = None
+    if args.gaze:
+        # pixels to angles with the camera model, see Gaze in nao_tracking.py
+        gaze = Gaze(motion, joint_names=joint_names)
+
+    controller = None
+    if args.controller_rate > 0:
+        # the head is moved at a fixed rate, independent of the frame rate, see HeadController in nao_tracking.py
+        controller = HeadController(motion, args.controller_rate, args.kp, args.ki, args.kd,
+                                    joint_names=joint_names)
+        controller.start()
+
+    capture = None
+    if args.capture_thread:
+        capture = CaptureThread(camProxy, nameID)
+        capture.start()
+
+    # the images are shown on their own thread, the loop never waits for the GUI
+    display = None
+    if not args.headless:
+        display = DisplayThread(args.display_fps)
+        display.start()
+
     try:
         frame = None
+        image = None
+        timestamp = None
+        head_angles = list(init_angle)
         # keep looping
         while True:
-            key = cv2.waitKey(33) & 0xFF
-            if key == ord('q') or key == 27:
+            if display is not None and display.quit.is_set():
                 break
 
-            frame = GetImage(frame, nameID)
-            frame, center = DetectBall(frame, color_bounds[args.ball_color][0], color_bounds[args.ball_color][1])
+            if capture is None:
+                new_frame = GetImage(frame, nameID)
+                if new_frame is None:
+                    # the same image again, it is not detected (and the head not moved) twice
+                    time.sleep(0.25 / args.fps)
+                    continue
+                frame = new_frame
+            else:
+                # newest frame of the capture thread (None until the first one arrived),
+                # waiting for a new one paces the loop now that it does not wait for keys
+                frame = capture.read(timeout=1.0)
+                if frame is None:
+                    continue
+                timestamp = capture.read_timestamp()
+            if args.color_space == kYUV422ColorSpace:
+                # one conversion with OpenCV, the detection goes on from BGR as with kBGRColorSpace
+                image = YUV422ToBGR(frame, image)
+            else:
+                image = frame
+            if tracker is None:
+                image, center = DetectBall(image, color_bounds[args.ball_color][0], color_bounds[args.ball_color][1])
+            else:
+                # the ball is predicted on every frame, but only detected when the tracker asks for it
+                center = tracker.predict(timestamp)
+                if tracker.due():
+                    image, center = DetectBall(image, color_bounds[args.ball_color][0], color_bounds[args.ball_color][1])
+                    center = tracker.correct(center)
+                if center is not None:
+                    cv2.circle(image, center, 5, (255, 0, 0), -1)
 
             # show the frame to our screen
-            cv2.imshow("frame", frame)
+            if display is not None:
+                display.show("frame", image)
+
+            # the head angles when the image was taken (in the clock of the robot, like the image timestamp),
+            # with --workers or --gate_threshold the center may belong to an earlier image than the one just taken,
+            # while the tracker predicts it for the current one
+            capture_angles = None
+            if history is not None and center is not None:
+                capture_angles = history.angles_at(timestamp if tracker is not None else detector.timestamp)
+
+            if controller is not None:
+                # the controller thread picks up the newest center
+                controller.update(center, (frame.shape[1], frame.shape[0]), capture_angles)
+
+            elif gaze is not None:
+                if center is not None:
+                    gaze.look_at(center, (frame.shape[1], frame.shape[0]), capture_angles)
 
             # if there is a ball in the image move the head in this direction
-            if (center):
+            elif (center):
                 midPoint = (frame.shape[1] / 2, frame.shape[0] / 2)
                 motionVector = (center[0] - midPoint[0], center[1] - midPoint[1])
 
                 motionVector = (motionVector[0] / 1000.0, motionVector[1] / 1000.0)
 
                 changes = [-motionVector[0], motionVector[1]]
-                motionProxy.changeAngles(joint_names, changes, fractionMaxSpeed)
+
+                # keep track of the commanded angles and clamp them to the joint limits,
+                # nothing is sent while the head is pushing into a limit
+                target, limits = ClampHeadAngles([head_angles[0] + changes[0], head_angles[1] + changes[1]])
+                changes = [target[0] - head_angles[0], target[1] - head_angles[1]]
+                if changes != [0.0, 0.0]:
+                    motion.changeAngles(joint_names, changes, fractionMaxSpeed)
+                    head_angles = target
+
+            if commander is not None and controller is None:
+                # a command held back by the interval is sent as soon as it is due
+                commander.flush()
+
+    except EndOfReplay:
+        print("end of the recorded session")
+
+    except KeyboardInterrupt:
+        print("interrupted")
 
     finally:  # if anything goes wrong we'll make sure to unsubscribe
+        if display is not None:
+            display.stop()
+        if history is not None:
+            history.stop()
+        if controller is not None:
+            controller.stop()
+            print("head controller {}: {}".format(controller.tuning, controller.stats()))
+        if commander is not None:
+            print("head commands: {}".format(commander.stats()))
+        if args.timing:
+            print("time per stage of the ball detection:\n{}".format(detector.timer.report()))
+            if tracker is not None:
+                print("tracker statistics: {}".format(tracker.stats()))
+            if gate is not None:
+                print("reused the last detection: {}, detected: {}".format(gate.hits, gate.misses))
+            if roi is not None:
+                print("found in the window: {}, searched the whole image: {}".format(roi.roi_hits,
+                                                                                   roi.full_searches))
+        if parallel is not None:
+            parallel.close()
+            print("parallel detection statistics: {}".format(parallel.stats()))
+        if capture is not None:
+            capture.stop()
+            print("capture statistics: {}".format(capture.stats()))
+        if replay is not None:
+            print("replay statistics: {}".format(replay.stats()))
         print("unsubscribing from {}".format(nameID))
         camProxy.unsubscribe(nameID)
         motionProxy.setStiffnesses(body_name, 0.0)
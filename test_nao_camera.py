@@ -0,0 +1,72 @@
+import cv2
+import numpy as np
+
+from nao_camera import YUV422ToHSV, YUV422ToBGR, DualCamera
+from nao_vision import BallDetector
+
+
+def test_yuv422_to_hsv_matches_bgr_path():
+    # the mask has to be computed from the colors of the image that is shown, saved and replayed
+    rng = np.random.RandomState(0)
+    for shape in [(240, 320, 2), (480, 640, 2)]:
+        yuv = rng.randint(0, 256, shape).astype(np.uint8)
+        expected = cv2.cvtColor(YUV422ToBGR(yuv), cv2.COLOR_BGR2HSV)
+        np.testing.assert_array_equal(YUV422ToHSV(yuv), expected)
+
+
+def test_yuv422_to_hsv_reuses_output():
+    yuv = np.full((4, 4, 2), 128, dtype=np.uint8)
+    yuv[:, 0::2, 1] = 100   # U
+    yuv[:, 1::2, 1] = 220   # V
+    yuv[:, :, 0] = 100      # Y
+    hsv = np.empty((4, 4, 3), dtype=np.uint8)
+    assert YUV422ToHSV(yuv, hsv) is hsv
+    np.testing.assert_array_equal(hsv, cv2.cvtColor(YUV422ToBGR(yuv), cv2.COLOR_BGR2HSV))
+
+
+class FakeVideoDevice(object):
+    '''Returns the same pair of images with the given timestamps on every call.'''
+
+    def __init__(self, top, bottom, seconds=(10.0, 10.0)):
+        self.images = [top, bottom]
+        self.seconds = seconds
+        self.calls = 0
+
+    def getImagesRemote(self, nameID):
+        self.calls += 1
+        return [[image.shape[1], image.shape[0], image.shape[2], 13, int(t), int((t - int(t)) * 1e6), image.tobytes()]
+                for image, t in zip(self.images, self.seconds)]
+
+
+def test_dual_camera_keeps_balls_at_the_seam_apart():
+    # a ball at the bottom edge of the top image and one at the top edge of the bottom image
+    top = np.zeros((240, 320, 3), dtype=np.uint8)
+    bottom = np.zeros((240, 320, 3), dtype=np.uint8)
+    cv2.circle(top, (100, 235), 25, (0, 0, 255), -1)
+    cv2.circle(bottom, (110, 10), 20, (0, 0, 255), -1)
+
+    dual = DualCamera(FakeVideoDevice(top, bottom), 'dual')
+    frame = dual.grab()
+    _, expected = BallDetector(draw=False).detect(top.copy(), (0, 200, 200), (20, 255, 255))
+    _, center = BallDetector(draw=False).detect(frame, (0, 200, 200), (20, 255, 255))
+    assert dual.split_center(center) == (0, expected)
+
+
+def test_dual_camera_retries_a_skewed_pair_once():
+    image = np.zeros((24, 32, 3), dtype=np.uint8)
+    device = FakeVideoDevice(image, image, seconds=(10.0, 10.1))
+    dual = DualCamera(device, 'dual', fps=1000)
+    dual.grab()
+    assert device.calls == 2
+    assert dual.stats() == {'grabbed': 1, 'retried': 1, 'skewed': 1}
+
+
+def test_dual_camera_skips_a_pair_it_already_grabbed():
+    image = np.zeros((24, 32, 3), dtype=np.uint8)
+    device = FakeVideoDevice(image, image)
+    dual = DualCamera(device, 'dual')
+    assert dual.grab() is not None
+    assert dual.grab() is None
+    device.seconds = (10.04, 10.04)
+    assert dual.grab() is not None
+    assert dual.stats() == {'grabbed': 2, 'retried': 0, 'skewed': 0}
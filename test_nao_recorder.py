@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+import pytest
+
+from nao_recorder import FrameRecorder, RecordingSegments, ReadEvents, EventsPath
+
+
+def record(prefix, n_frames, capacity=2, overwrite=False, touch=False):
+    recorder = FrameRecorder(prefix, continuous=True, capacity=capacity, overwrite=overwrite)
+    for k in range(n_frames):
+        recorder.offer(np.full((4, 6, 3), k, dtype=np.uint8), k, 0)
+    if touch:
+        recorder.event('MiddleTactilTouched', 1.0)
+    recorder.close()
+
+
+def test_refuses_to_extend_an_older_recording(tmpdir):
+    prefix = os.path.join(str(tmpdir), 'session')
+    record(prefix, 5)
+    with pytest.raises(ValueError):
+        FrameRecorder(prefix)
+    assert len(RecordingSegments(prefix)) == 3
+
+
+def test_overwrite_removes_segments_and_events(tmpdir):
+    prefix = os.path.join(str(tmpdir), 'session')
+    record(prefix, 5, touch=True)
+    assert len(ReadEvents(prefix)) == 1
+
+    # a shorter run without events leaves nothing of the first one behind
+    record(prefix, 1, overwrite=True)
+    assert len(RecordingSegments(prefix)) == 1
+    assert not os.path.isfile(EventsPath(prefix))
+    assert ReadEvents(prefix) == []
+
+
+def test_a_run_without_frames_or_events_leaves_no_files(tmpdir):
+    prefix = os.path.join(str(tmpdir), 'recordings', 'session')
+    FrameRecorder(prefix).close()
+    assert not os.path.exists(os.path.dirname(prefix))
+    # so the next run with the same prefix starts
+    record(prefix, 1)
+    assert len(RecordingSegments(prefix)) == 1
@@ -0,0 +1,138 @@
+import cv2
+import numpy as np
+import pytest
+
+from nao_vision import BallDetector, MultiBallDetector, PyramidBallDetector, ParallelBallDetector, ColorLUT, PeakAllocation, \
+    DEFAULT_STAGES, tracemalloc
+
+COLOR_BOUNDS = {'yellow': [(10, 150, 150), (50, 255, 255)],
+                'green': [(60, 100, 50), (100, 200, 150)],
+                'red': [(0, 200, 200), (20, 255, 255)]}
+
+ALL_COLOR_STAGES = [('hsv', 'threshold', 'erode', 'dilate', 'contours'),
+                    ('lut', 'erode', 'dilate', 'contours'),
+                    ('hsv', 'threshold', 'erode', 'dilate', 'components'),
+                    ('lut', 'erode', 'dilate', 'components')]
+
+
+def Balls(*balls):
+    '''A black 320 x 240 frame with the balls (center, radius, BGR color) drawn in this order.'''
+    frame = np.zeros((240, 320, 3), dtype=np.uint8)
+    for center, radius, color in balls:
+        cv2.circle(frame, center, radius, color, -1)
+    return frame
+
+
+@pytest.mark.parametrize('stages', ALL_COLOR_STAGES)
+def test_all_colors_match_one_detector_per_color(stages, tmpdir):
+    frames = [
+        # a red and a yellow ball that touch
+        Balls(((119, 120), 30, (0, 0, 255)), ((175, 120), 30, (0, 255, 255))),
+        # an orange ball, within the red and the yellow range
+        Balls(((160, 120), 30, (0, 128, 255))),
+    ]
+    for frame in frames:
+        _, centers = MultiBallDetector(COLOR_BOUNDS, stages, draw=False, lut_cache_dir=str(tmpdir)).detect(frame.copy())
+        for name, (lower, upper) in COLOR_BOUNDS.items():
+            _, center = BallDetector(stages, draw=False, lut_cache_dir=str(tmpdir)).detect(frame.copy(), lower, upper)
+            assert centers[name] == center
+
+
+@pytest.mark.parametrize('stages', ALL_COLOR_STAGES + [('blur', 'hsv', 'threshold', 'dilate', 'erode', 'contours'),
+                                                      ('hsv', 'threshold', 'contours')])
+def test_eight_colors_on_noisy_frames_match_one_detector_per_color(stages, tmpdir):
+    rng = np.random.RandomState(0)
+    color_bounds = dict(('color{}'.format(k), [(22 * k, 80, 60), (22 * k + 30, 255, 255)]) for k in range(8))
+    multi = MultiBallDetector(color_bounds, stages, draw=False, lut_cache_dir=str(tmpdir))
+    detector = BallDetector(stages, draw=False, lut_cache_dir=str(tmpdir))
+    for _ in range(5):
+        frame = rng.randint(0, 60, (240, 320, 3)).astype(np.uint8)
+        for _ in range(8):
+            bgr = cv2.cvtColor(np.uint8([[[rng.randint(0, 180), 220, 220]]]), cv2.COLOR_HSV2BGR)[0, 0]
+            cv2.circle(frame, (rng.randint(0, 320), rng.randint(0, 240)), rng.randint(5, 40), bgr.tolist(), -1)
+        noise = rng.rand(240, 320) < 0.01
+        frame[noise] = rng.randint(0, 256, (noise.sum(), 3))
+
+        _, centers = multi.detect(frame.copy())
+        for name, (lower, upper) in color_bounds.items():
+            assert centers[name] == detector.detect(frame.copy(), lower, upper)[1]
+
+
+@pytest.mark.parametrize('stages', ALL_COLOR_STAGES)
+def test_touching_balls_stay_apart(stages, tmpdir):
+    frame = Balls(((119, 120), 30, (0, 0, 255)), ((179, 120), 30, (0, 255, 255)))
+    _, centers = MultiBallDetector(COLOR_BOUNDS, stages, draw=False, lut_cache_dir=str(tmpdir)).detect(frame)
+    assert abs(centers['red'][0] - 119) <= 1 and abs(centers['red'][1] - 120) <= 1
+    assert abs(centers['yellow'][0] - 179) <= 1 and abs(centers['yellow'][1] - 120) <= 1
+    assert centers['green'] is None
+
+
+def test_color_lut_cache_is_keyed_by_the_version(tmpdir, monkeypatch):
+    lut = ColorLUT(COLOR_BOUNDS, cache_dir=str(tmpdir))
+    assert len(tmpdir.listdir()) == 1
+    np.testing.assert_array_equal(ColorLUT(COLOR_BOUNDS, cache_dir=str(tmpdir)).table, lut.table)
+    assert len(tmpdir.listdir()) == 1
+
+    # a table compiled by another version is not loaded
+    monkeypatch.setattr(ColorLUT, 'VERSION', ColorLUT.VERSION + 1)
+    monkeypatch.setattr(ColorLUT, 'compile', lambda self: np.zeros_like(lut.table))
+    assert not ColorLUT(COLOR_BOUNDS, cache_dir=str(tmpdir)).table.any()
+    assert len(tmpdir.listdir()) == 2
+
+
+@pytest.mark.parametrize('factor', [2, 4])
+def test_pyramid_finds_the_same_small_balls(factor):
+    lower, upper = COLOR_BOUNDS['red']
+    for radius in range(8, 16):
+        frame = np.zeros((480, 640, 3), dtype=np.uint8)
+        cv2.circle(frame, (301, 203), radius, (0, 0, 255), -1)
+        _, expected = BallDetector(draw=False).detect(frame, lower, upper)
+        _, center = PyramidBallDetector(factor=factor, draw=False).detect(frame, lower, upper)
+        assert center == expected
+
+
+def test_parallel_raises_the_error_of_a_worker():
+    lower, upper = COLOR_BOUNDS['red']
+    parallel = ParallelBallDetector(n_workers=2)
+    try:
+        # the HSV conversion fails for 2 channels
+        with pytest.raises(RuntimeError, match='worker process'):
+            parallel.submit(np.zeros((24, 32, 2), dtype=np.uint8), lower, upper)
+            parallel.results(block=True)
+    finally:
+        parallel.close()
+    assert parallel.stats()['failed'] == 1
+
+
+def test_parallel_does_not_wait_for_a_dead_worker():
+    lower, upper = COLOR_BOUNDS['red']
+    frame = Balls(((119, 120), 30, (0, 0, 255)))
+    parallel = ParallelBallDetector(n_workers=1)
+    try:
+        parallel.submit(frame, lower, upper)
+        assert [result[2] for result in parallel.results(block=True)] == [(119, 120)]
+
+        parallel.workers[0].terminate()
+        parallel.workers[0].join()
+        parallel.submit(frame, lower, upper)
+        with pytest.raises(RuntimeError, match='exited'):
+            parallel.results(block=True)
+    finally:
+        parallel.close()
+
+
+@pytest.mark.skipif(tracemalloc is None, reason='tracemalloc needs Python 3.4 or later')
+@pytest.mark.parametrize('stages', [DEFAULT_STAGES,
+                                    ('lut', 'erode', 'dilate', 'contours'),
+                                    ('hsv', 'threshold', 'erode', 'dilate', 'components')])
+def test_no_allocations_per_frame(stages, tmpdir):
+    lower, upper = COLOR_BOUNDS['red']
+    frames = []
+    for k in range(15):
+        frame = np.zeros((480, 640, 3), dtype=np.uint8)
+        cv2.circle(frame, (100 + 20 * k, 200), 30, (0, 0, 255), -1)
+        frames.append(frame)
+
+    peak = PeakAllocation(BallDetector(stages, lut_cache_dir=str(tmpdir)), frames, lower, upper)
+    # the buffers are allocated during the warmup, a frame is 900 KB
+    assert peak < frames[0].nbytes // 100